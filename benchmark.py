@@ -0,0 +1,558 @@
+"""End-to-end load and latency benchmark for WanVideoBot
+
+Drives the real handlers (handle_callback, handle_message, handle_skip,
+generate_video) with synthetic events from N simulated users. A fake
+Telegram client stands in for Telethon and a local aiohttp app stands in
+for the /api/generate/* endpoints; it answers with configurable
+latency and failure rates and calls the bot's /webhook back with a video
+of realistic size.
+
+The report covers throughput, p50/p95/p99 per stage, event loop lag and
+peak RSS, so runs can be compared before deploys.
+
+Usage:
+    python benchmark.py --users 200 --modes t2v,i2v --gen-time 3 --video-size 4000000
+    python benchmark.py --users 100 --modes animate,camera --clip-size 1920x1080
+    python benchmark.py --users 500 --max-global 20 --json results.json
+    python benchmark.py --users 200 --batch --batch-size 8 --submit-latency 1
+"""
+import os
+import json
+import time
+import base64
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import subprocess
+import itertools
+import importlib
+import logging
+import resource
+import tempfile
+from types import SimpleNamespace
+from typing import Optional, Dict, Any
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+
+logger = logging.getLogger('benchmark')
+
+def free_port() -> int:
+    """Pick a free local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentile(values: list, q: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+# Fake Telegram
+class FakeMedia:
+    """Stands in for the media object of an uploaded file"""
+    def __init__(self, size: int):
+        self.size = size
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, client: 'FakeTelegram', chat_id: int, text: str = '', media: Optional[FakeMedia] = None):
+        self.id = next(self._ids)
+        self.client = client
+        self.chat_id = chat_id
+        self.text = text
+        self.media = media
+
+    async def edit(self, text: str, **kwargs):
+        await self.client.api_call('edit')
+        self.text = text
+        self.client.observe_text(self.chat_id, text)
+        return self
+
+class FakeTelegram:
+    """Minimal TelegramClient replacement with simulated API and upload latency"""
+    def __init__(self, loop: asyncio.AbstractEventLoop, api_latency: float, upload_bandwidth: float):
+        self.loop = loop
+        self.api_latency = api_latency
+        self.upload_bandwidth = upload_bandwidth
+        self.calls = defaultdict(int)
+        self.uploaded_bytes = 0
+        self.listener = None
+
+    def on(self, event_builder):
+        def decorator(handler):
+            return handler
+        return decorator
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def api_call(self, method: str, extra: float = 0.0):
+        self.calls[method] += 1
+        await asyncio.sleep(self.api_latency * random.uniform(0.5, 1.5) + extra)
+
+    def observe_text(self, chat_id: int, text: str):
+        if self.listener:
+            self.listener.on_text(chat_id, text)
+
+    async def send_message(self, chat_id: int, text: str = '', **kwargs) -> FakeMessage:
+        await self.api_call('send_message')
+        self.observe_text(chat_id, text)
+        return FakeMessage(self, chat_id, text)
+
+    async def send_file(self, chat_id: int, file, caption: str = '', **kwargs) -> FakeMessage:
+        if isinstance(file, FakeMedia):
+            media = file
+            await self.api_call('send_file_reference')
+        elif isinstance(file, str):
+            size = os.path.getsize(file)
+            self.uploaded_bytes += size
+            media = FakeMedia(size)
+            await self.api_call('send_file_upload', size / self.upload_bandwidth)
+        else:
+            data = file.read()
+            media = FakeMedia(len(data))
+            await self.api_call('send_file_upload', len(data) / self.upload_bandwidth)
+        if self.listener:
+            self.listener.on_file(chat_id, media)
+        return FakeMessage(self, chat_id, caption, media)
+
+class FakeEvent:
+    """Synthetic NewMessage / CallbackQuery event for one simulated user"""
+    def __init__(self, client: FakeTelegram, user_id: int, text: str = '', data: Optional[str] = None,
+                 media_path: Optional[str] = None, mime_type: Optional[str] = None,
+                 download_bandwidth: float = 20e6):
+        self.client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.text = text
+        self.data = data.encode('utf-8') if data is not None else None
+        self.pattern_match = None
+        self.media_path = media_path
+        self.media = media_path
+        self.photo = None
+        self.video = None
+        self.download_bandwidth = download_bandwidth
+        if media_path:
+            ext = os.path.splitext(media_path)[1]
+            self.file = SimpleNamespace(size=os.path.getsize(media_path), mime_type=mime_type, ext=ext)
+            self.document = SimpleNamespace(mime_type=mime_type)
+        else:
+            self.file = None
+            self.document = None
+
+    async def respond(self, text: str = '', **kwargs) -> FakeMessage:
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    async def edit(self, text: str = '', **kwargs) -> FakeMessage:
+        await self.client.api_call('edit')
+        self.client.observe_text(self.chat_id, text)
+        return FakeMessage(self.client, self.chat_id, text)
+
+    async def answer(self, text: Optional[str] = None, alert: bool = False):
+        await self.client.api_call('answer')
+        if text:
+            self.client.observe_text(self.chat_id, text)
+
+    async def download_media(self, file: str) -> str:
+        await self.client.api_call('download', self.file.size / self.download_bandwidth)
+        await asyncio.to_thread(shutil.copyfile, self.media_path, file)
+        return file
+
+# Fake Modal backend
+class FakeBackend:
+    """Local stand-in for the generation endpoints that calls the bot's webhook back"""
+    def __init__(self, port: int, args):
+        self.port = port
+        self.args = args
+        self.gpus = asyncio.Semaphore(args.gpus)
+        self.video_b64 = base64.b64encode(os.urandom(args.video_size)).decode('ascii')
+        self.submits = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.request_bytes = 0
+        self.jobs = set()
+        self.app = web.Application(client_max_size=1024 ** 3)
+        # Registered before {mode} so "batch" is not taken for a generation mode
+        self.app.router.add_post('/api/generate/batch', self.handle_batch)
+        self.app.router.add_post('/api/generate/{mode}', self.handle_generate)
+        self.app.router.add_get('/health', self.health)
+        self.runner = None
+        self.session = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession()
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        for job in self.jobs:
+            job.cancel()
+        await self.runner.cleanup()
+        await self.session.close()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        self.submits += 1
+        self.request_bytes += len(body)
+        await asyncio.sleep(self.args.submit_latency * random.uniform(0.5, 1.5))
+        if random.random() < self.args.submit_failure_rate:
+            self.rejected += 1
+            return web.json_response({"detail": "simulated overload"}, status=503)
+
+        payload = json.loads(body)
+        self.start_job(payload)
+        return web.json_response({"status": "queued", "task_id": payload['task_id']})
+
+    async def handle_batch(self, request: web.Request) -> web.Response:
+        """One request carrying several jobs; pays the submit latency once"""
+        body = await request.read()
+        self.submits += 1
+        self.request_bytes += len(body)
+        await asyncio.sleep(self.args.submit_latency * random.uniform(0.5, 1.5))
+        if random.random() < self.args.submit_failure_rate:
+            self.rejected += 1
+            return web.json_response({"detail": "simulated overload"}, status=503)
+
+        results = []
+        for payload in json.loads(body)['jobs']:
+            self.start_job(payload)
+            results.append({"task_id": payload['task_id'], "status_code": 200, "status": "queued"})
+        return web.json_response({"results": results})
+
+    def start_job(self, payload: Dict[str, Any]):
+        self.accepted += 1
+        job = asyncio.create_task(self.run_job(payload['task_id'], payload['webhook_url'], payload.get('steps', 20)))
+        self.jobs.add(job)
+        job.add_done_callback(self.jobs.discard)
+
+    async def run_job(self, task_id: str, webhook_url: str, steps: int):
+        await self.post(webhook_url, {"task_id": task_id, "status": "queued"})
+        async with self.gpus:
+            duration = self.args.gen_time * random.uniform(0.7, 1.3)
+            updates = self.args.progress_updates
+            for update in range(1, updates + 1):
+                await asyncio.sleep(duration / (updates + 1))
+                await self.post(webhook_url, {
+                    "task_id": task_id, "status": "progress",
+                    "step": round(steps * update / updates), "steps": steps
+                })
+            await asyncio.sleep(duration / (updates + 1))
+
+        if random.random() < self.args.job_failure_rate:
+            result = {"task_id": task_id, "status": "error", "detail": "simulated GPU failure"}
+        else:
+            result = {"task_id": task_id, "status": "success", "video_base64": self.video_b64}
+        await self.post(webhook_url, result, retries=10)
+
+    async def post(self, url: str, payload: Dict[str, Any], retries: int = 0):
+        """POST to the webhook, honouring 503 Retry-After like the real backend should"""
+        body = json.dumps(payload).encode('utf-8')
+        for attempt in range(retries + 1):
+            try:
+                async with self.session.post(url, data=body, headers={'Content-Type': 'application/json'}) as response:
+                    if response.status != 503:
+                        return
+                    delay = float(response.headers.get('Retry-After', '1'))
+            except aiohttp.ClientError as e:
+                logger.warning(f"Webhook post failed: {e!r}")
+                delay = 1.0
+            await asyncio.sleep(delay)
+
+# Load driver
+class Recorder:
+    """Collects stage latencies and per-user outcomes"""
+    FAILURE_MARKERS = ('error occurred', 'Failed to submit', 'timed out', 'unavailable', 'Error submitting')
+    REJECTION_MARKERS = ('queue is full', 'quota reached', 'fully booked', 'task(s) in progress', 'paused')
+
+    def __init__(self):
+        self.stages = defaultdict(list)
+        self.waiting = {}
+        self.outcomes = defaultdict(int)
+        self.first_generate = None
+        self.last_delivery = None
+
+    def expect(self, user_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[user_id] = future
+        return future
+
+    def _resolve(self, user_id: int, outcome: str):
+        future = self.waiting.pop(user_id, None)
+        if future is not None and not future.done():
+            future.set_result((outcome, time.perf_counter()))
+
+    def on_file(self, chat_id: int, media: FakeMedia):
+        self._resolve(chat_id, 'delivered')
+
+    def on_text(self, chat_id: int, text: str):
+        if chat_id not in self.waiting:
+            return
+        if any(marker in text for marker in self.FAILURE_MARKERS):
+            self._resolve(chat_id, 'failed')
+        elif any(marker in text for marker in self.REJECTION_MARKERS):
+            self._resolve(chat_id, 'rejected')
+
+async def timed(recorder: Recorder, stage: str, coro):
+    started = time.perf_counter()
+    await coro
+    recorder.stages[stage].append(time.perf_counter() - started)
+
+async def simulate_user(bot, client: FakeTelegram, recorder: Recorder, user_id: int, args, image_path: str,
+                        clip_path: Optional[str]):
+    """One user walking the wizard and generating `rounds` videos"""
+    think = lambda: asyncio.sleep(random.expovariate(1 / args.think_time) if args.think_time else 0)
+    event = lambda **kwargs: FakeEvent(client, user_id, download_bandwidth=args.download_bandwidth, **kwargs)
+    modes = args.modes.split(',')
+
+    for round_index in range(args.rounds):
+        mode = random.choice(modes)
+        shared = random.random() < args.duplicate_rate
+        prompt = "A calm lake at sunrise with drifting fog" if shared else f"User {user_id} scene {round_index} {random.random()}"
+
+        if mode == 'camera':
+            await timed(recorder, 'menu', bot.handle_callback(event(data='camera')))
+            await think()
+            await timed(recorder, 'menu', bot.handle_callback(event(data='camera_ZoomIn')))
+        else:
+            await timed(recorder, 'menu', bot.handle_callback(event(data=mode)))
+        await think()
+
+        if mode in ('i2v', 'camera', 'animate'):
+            await timed(recorder, 'image', bot.handle_message(event(media_path=image_path, mime_type='image/jpeg')))
+            await think()
+        if mode == 'animate':
+            await timed(recorder, 'video', bot.handle_message(event(media_path=clip_path, mime_type='video/mp4')))
+            await think()
+
+        await timed(recorder, 'prompt', bot.handle_message(event(text=prompt)))
+        await think()
+        await timed(recorder, 'skip', bot.handle_skip(event(text='/skip')))
+        await think()
+
+        outcome = recorder.expect(user_id)
+        clicked = time.perf_counter()
+        recorder.first_generate = recorder.first_generate or clicked
+        await timed(recorder, 'generate', bot.handle_callback(event(data='generate')))
+        try:
+            result, finished = await asyncio.wait_for(outcome, args.timeout)
+        except asyncio.TimeoutError:
+            recorder.waiting.pop(user_id, None)
+            recorder.outcomes['lost'] += 1
+            continue
+        recorder.outcomes[result] += 1
+        if result == 'delivered':
+            recorder.stages['end_to_end'].append(finished - clicked)
+            recorder.last_delivery = finished
+        await think()
+
+async def sample_loop_lag(samples: list, interval: float = 0.05):
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - expected))
+
+def make_image(path: str, width: int, height: int):
+    """Noisy JPEG so compression and resizing cost what real photos do"""
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    noise.save(path, 'JPEG', quality=92)
+
+def make_clip(path: str, width: int, height: int, seconds: float):
+    """Noisy H.264 MP4 so downloading and normalizing cost what phone clips do"""
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y', '-f', 'lavfi',
+        '-i', f'testsrc2=size={width}x{height}:rate=30,noise=alls=40:allf=t',
+        '-t', str(seconds), '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path
+    ], check=True)
+
+async def run_benchmark(bot, client: FakeTelegram, backend: FakeBackend, args, image_path: str,
+                        clip_path: Optional[str]) -> Dict[str, Any]:
+    recorder = Recorder()
+    client.listener = recorder
+    lag_samples = []
+
+    await backend.start()
+    await bot.start()
+    lag_task = asyncio.create_task(sample_loop_lag(lag_samples))
+    started = time.perf_counter()
+    try:
+        users = []
+        for index in range(args.users):
+            users.append(asyncio.create_task(
+                simulate_user(bot, client, recorder, 100000 + index, args, image_path, clip_path)
+            ))
+            if args.arrival_rate:
+                await asyncio.sleep(random.expovariate(args.arrival_rate))
+        await asyncio.gather(*users)
+    finally:
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        await bot.stop()
+        await backend.stop()
+
+    delivered = recorder.outcomes['delivered']
+    window = (recorder.last_delivery - recorder.first_generate) if delivered else 0.0
+    return {
+        'users': args.users,
+        'rounds': args.rounds,
+        'elapsed_seconds': elapsed,
+        'outcomes': dict(recorder.outcomes),
+        'throughput_videos_per_minute': 60 * delivered / window if window else 0.0,
+        'stages': {
+            stage: {
+                'count': len(values),
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': max(values)
+            }
+            for stage, values in recorder.stages.items()
+        },
+        'loop_lag': {
+            'p50': percentile(lag_samples, 0.50),
+            'p99': percentile(lag_samples, 0.99),
+            'max': max(lag_samples, default=0.0)
+        },
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'backend': {
+            'submits': backend.submits,
+            'jobs': backend.accepted,
+            'rejected': backend.rejected,
+            'mean_request_kb': backend.request_bytes / backend.submits / 1024 if backend.submits else 0.0
+        },
+        'telegram_calls': dict(client.calls),
+        'uploaded_mb': client.uploaded_bytes / 1024 / 1024
+    }
+
+def print_report(report: Dict[str, Any]):
+    print(f"\nUsers: {report['users']} x {report['rounds']} round(s) in {report['elapsed_seconds']:.1f}s")
+    print(f"Outcomes: {report['outcomes']}")
+    print(f"Throughput: {report['throughput_videos_per_minute']:.1f} videos/min")
+    print(f"\n{'stage':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, values in report['stages'].items():
+        print(f"{stage:<12}{values['count']:>8}" + ''.join(
+            f"{values[key] * 1000:>10.1f}" for key in ('p50', 'p95', 'p99', 'max')
+        ))
+    lag = report['loop_lag']
+    print(f"\nEvent loop lag: p50 {(lag['p50'] or 0) * 1000:.1f} ms, p99 {(lag['p99'] or 0) * 1000:.1f} ms, "
+          f"max {lag['max'] * 1000:.1f} ms")
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+    print(f"Backend: {report['backend']}")
+    print(f"Telegram calls: {report['telegram_calls']}, uploaded {report['uploaded_mb']:.1f} MB")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=1, help='videos generated per user, one after another')
+    parser.add_argument('--modes', default='t2v,i2v', help='comma-separated subset of t2v,i2v,animate,camera')
+    parser.add_argument('--arrival-rate', type=float, default=20.0, help='new users per second; 0 starts all at once')
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean seconds between wizard steps')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of requests with a common prompt')
+    parser.add_argument('--gen-time', type=float, default=5.0, help='mean seconds a fake GPU job takes')
+    parser.add_argument('--gpus', type=int, default=10, help='jobs the fake backend runs at once')
+    parser.add_argument('--progress-updates', type=int, default=5)
+    parser.add_argument('--submit-latency', type=float, default=0.2)
+    parser.add_argument('--submit-failure-rate', type=float, default=0.0)
+    parser.add_argument('--job-failure-rate', type=float, default=0.0)
+    parser.add_argument('--video-size', type=int, default=3 * 1024 * 1024, help='bytes of the returned video')
+    parser.add_argument('--image-size', default='1920x1080', help='WxH of the uploaded test image')
+    parser.add_argument('--clip-size', default='1280x720', help='WxH of the uploaded driving video (animate)')
+    parser.add_argument('--clip-seconds', type=float, default=5.0, help='length of the uploaded driving video')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds per fake Telegram API call')
+    parser.add_argument('--upload-bandwidth', type=float, default=20e6, help='bytes/s for fake Telegram uploads')
+    parser.add_argument('--download-bandwidth', type=float, default=20e6, help='bytes/s for fake media downloads')
+    parser.add_argument('--max-global', type=int, help='override MAX_GLOBAL_QUEUE')
+    parser.add_argument('--user-budget', type=float, default=1e9, help='per-user GPU-seconds per hour')
+    parser.add_argument('--gpu-rate', type=float, default=10.0, help='GPU-seconds per second the bot admits')
+    parser.add_argument('--gpu-burst', type=float, default=1e9, help='GPU-seconds the bot admits in a burst')
+    parser.add_argument('--batch', action='store_true', help='submit through the backend batch endpoint')
+    parser.add_argument('--batch-window', type=float, default=0.25, help='seconds to gather a batch')
+    parser.add_argument('--batch-size', type=int, default=4, help='most jobs per batch request')
+    parser.add_argument('--max-waiting', type=int, help='override MAX_WAITING_QUEUE')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds to wait for each video')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    unknown = set(args.modes.split(',')) - {'t2v', 'i2v', 'animate', 'camera'}
+    if unknown:
+        parser.error(f"unsupported mode(s): {', '.join(sorted(unknown))}")
+    if 'animate' in args.modes.split(',') and not shutil.which('ffmpeg'):
+        parser.error("animate mode needs ffmpeg to make the driving video")
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    # The bot reads its configuration at import time, so point it at the fakes first
+    workdir = tempfile.mkdtemp(prefix='wanbot-bench-')
+    backend_port, webhook_port = free_port(), free_port()
+    os.environ.update({
+        'MODAL_API_URLS': f'http://127.0.0.1:{backend_port}',
+        'KINSTA_PUBLIC_URL': f'http://127.0.0.1:{webhook_port}',
+        'PORT': str(webhook_port),
+        'MEDIA_TMP_DIR': os.path.join(workdir, 'media'),
+        'RESULT_TMP_DIR': os.path.join(workdir, 'results'),
+        'SESSION_DIR': os.path.join(workdir, 'wizard'),
+        'RESULT_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'TASK_DB_PATH': os.path.join(workdir, 'tasks.db'),
+        'COORDINATION_DB_PATH': os.path.join(workdir, 'coordination.db'),
+        # Per-user quotas would otherwise cap each simulated user at a handful of videos
+        'USER_GPU_BUDGET': str(args.user_budget),
+        'GLOBAL_GPU_RATE': str(args.gpu_rate),
+        'GLOBAL_GPU_BURST': str(args.gpu_burst),
+    })
+    if args.max_waiting is not None:
+        os.environ['MAX_WAITING_QUEUE'] = str(args.max_waiting)
+    if args.batch:
+        os.environ.update({
+            'BACKEND_BATCH_PATH': '/api/generate/batch',
+            'BATCH_WINDOW': str(args.batch_window),
+            'BATCH_MAX_SIZE': str(args.batch_size),
+        })
+    bot_module = importlib.import_module('bot')
+    bot_module.logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    image_path = os.path.join(workdir, 'input.jpg')
+    width, height = (int(value) for value in args.image_size.split('x'))
+    make_image(image_path, width, height)
+    clip_path = None
+    if 'animate' in args.modes.split(','):
+        clip_path = os.path.join(workdir, 'driving.mp4')
+        width, height = (int(value) for value in args.clip_size.split('x'))
+        make_clip(clip_path, width, height, args.clip_seconds)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = FakeTelegram(loop, args.api_latency, args.upload_bandwidth)
+    bot = bot_module.WanVideoBot(client)
+
+    if args.max_global is not None:
+        bot.task_queue.max_global = args.max_global
+
+    backend = FakeBackend(backend_port, args)
+    try:
+        report = loop.run_until_complete(run_benchmark(bot, client, backend, args, image_path, clip_path))
+    finally:
+        loop.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,37 @@
 import os
-import base64
+import re
+import sys
+import pickle
+import hashlib
+import heapq
 import io
+import base64
+import bisect
+import binascii
+import json
+import math
+import time
+import queue
+import random
+import shutil
+import sqlite3
 import asyncio
 import logging
+import tempfile
 import threading
+import traceback
 import uuid
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, AsyncIterator
+from collections import defaultdict, deque, Counter as StackCounter, OrderedDict
 
-import requests
-from telethon import TelegramClient, events
+import aiohttp
+from aiohttp import web
+from PIL import Image, ImageOps, UnidentifiedImageError
+from telethon import TelegramClient, events, errors
 from telethon.tl.custom import Button
-from flask import Flask, request, jsonify
+from telethon.tl.types import DocumentAttributeFilename
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +45,7 @@ API_ID = int(os.getenv('API_ID', '10446785'))
 API_HASH = os.getenv('API_HASH', '4261b62d60200eb99a38dcd8b71c8634')
 BOT_TOKEN = os.getenv('BOT_TOKEN', '8222362928:AAG85K4WRPmf2yBPb_6j3uJiMHDYgscgolc')
 MODAL_API_URL = os.getenv('MODAL_API_URL', 'https://oktetod--comfyui-wan2-2-production-fastapi-web.modal.run/')
+MODAL_API_URLS = [url.strip() for url in os.getenv('MODAL_API_URLS', MODAL_API_URL).split(',') if url.strip()]
 ADMIN_ID = int(os.getenv('ADMIN_ID', '8484686373'))
 BOT_USERNAME = os.getenv('BOT_USERNAME', 'WanVideoBot')
 
@@ -34,210 +54,2812 @@ MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
 SUPPORTED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/webp']
 SUPPORTED_VIDEO_TYPES = ['video/mp4', 'video/webm']
 
-# Rate limiting configuration
-RATE_LIMIT_WINDOW = 3600  # 1 hour in seconds
-MAX_REQUESTS_PER_HOUR = 5
+# Media ingest configuration
+MEDIA_TMP_DIR = os.getenv('MEDIA_TMP_DIR', os.path.join(tempfile.gettempdir(), 'wanbot-media'))
+MEDIA_READ_CHUNK = 3 * 64 * 1024  # multiple of 3 so base64 chunks concatenate cleanly
+IMAGE_PREPROCESS_WORKERS = int(os.getenv('IMAGE_PREPROCESS_WORKERS', '2'))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '90'))
+FFMPEG_WORKERS = int(os.getenv('FFMPEG_WORKERS', '2'))
+FFMPEG_TIMEOUT = float(os.getenv('FFMPEG_TIMEOUT', '60'))
+ANIMATE_VIDEO_FPS = int(os.getenv('ANIMATE_VIDEO_FPS', '16'))
+ANIMATE_VIDEO_MAXRATE = os.getenv('ANIMATE_VIDEO_MAXRATE', '2M')
+RESULT_TMP_DIR = os.getenv('RESULT_TMP_DIR', os.path.join(tempfile.gettempdir(), 'wanbot-results'))
+
+# Rate limiting configuration: quotas are token buckets of estimated GPU-seconds
+RATE_LIMIT_WINDOW = 3600  # 1 hour in seconds, the time an empty user quota takes to refill
+USER_GPU_BUDGET = float(os.getenv('USER_GPU_BUDGET', '600'))
+GLOBAL_GPU_RATE = float(os.getenv('GLOBAL_GPU_RATE', '10'))  # GPU-seconds the backend absorbs per second
+GLOBAL_GPU_BURST = float(os.getenv('GLOBAL_GPU_BURST', '3600'))
 CONCURRENT_TASKS_PER_USER = 1
 
+# Cost model configuration: a job's work is num_frames * steps * pixels relative to 832x480
+COST_SECONDS_PER_UNIT = float(os.getenv('COST_SECONDS_PER_UNIT', '0.03'))
+COST_OVERHEAD = float(os.getenv('COST_OVERHEAD', '10'))
+COST_LEARNING_RATE = float(os.getenv('COST_LEARNING_RATE', '0.1'))
+
 # Queue configuration
 MAX_GLOBAL_QUEUE = 10
+MAX_WAITING_QUEUE = int(os.getenv('MAX_WAITING_QUEUE', '50'))
+TASK_DURATION_ESTIMATE = float(os.getenv('TASK_DURATION_ESTIMATE', '120'))
+
+# Fair scheduling configuration: per tier, the round-robin weight, concurrent tasks per user
+# and the share of the holding queue its users may fill
+PREMIUM_USER_IDS = {int(user_id) for user_id in os.getenv('PREMIUM_USER_IDS', '').split(',') if user_id.strip()}
+TIER_ADMIN_WEIGHT = max(0.1, float(os.getenv('TIER_ADMIN_WEIGHT', '8')))
+TIER_ADMIN_TASKS = int(os.getenv('TIER_ADMIN_TASKS', '3'))
+TIER_ADMIN_HELD_SHARE = float(os.getenv('TIER_ADMIN_HELD_SHARE', '1.0'))
+TIER_PREMIUM_WEIGHT = max(0.1, float(os.getenv('TIER_PREMIUM_WEIGHT', '4')))
+TIER_PREMIUM_TASKS = int(os.getenv('TIER_PREMIUM_TASKS', '2'))
+TIER_PREMIUM_HELD_SHARE = float(os.getenv('TIER_PREMIUM_HELD_SHARE', '1.0'))
+TIER_FREE_WEIGHT = max(0.1, float(os.getenv('TIER_FREE_WEIGHT', '1')))
+TIER_FREE_TASKS = int(os.getenv('TIER_FREE_TASKS', str(CONCURRENT_TASKS_PER_USER)))
+TIER_FREE_HELD_SHARE = float(os.getenv('TIER_FREE_HELD_SHARE', '0.8'))
+
+# Stuck task reaper configuration
+TASK_TIMEOUT_BASE = float(os.getenv('TASK_TIMEOUT_BASE', '180'))
+TASK_TIMEOUT_PER_UNIT = float(os.getenv('TASK_TIMEOUT_PER_UNIT', '0.15'))  # seconds per frame x step at 832x480
+TASK_TIMEOUT_EXTENSION = float(os.getenv('TASK_TIMEOUT_EXTENSION', '300'))
+TASK_MAX_EXTENSIONS = int(os.getenv('TASK_MAX_EXTENSIONS', '2'))
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '15'))
+
+# Session store configuration
+SESSION_TTL = int(os.getenv('SESSION_TTL', '1800'))
+SESSION_MEMORY_BUDGET = int(os.getenv('SESSION_MEMORY_BUDGET', str(1024 * 1024 * 1024)))
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')  # 'memory' or 'disk'
+SESSION_DIR = os.getenv('SESSION_DIR', 'sessions/wizard')
+SESSION_SWEEP_INTERVAL = 60
+
+# Result cache configuration
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'sessions/cache')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+# Task store configuration
+TASK_DB_PATH = os.getenv('TASK_DB_PATH', 'sessions/tasks.db')
+TASK_DB_FLUSH_INTERVAL = float(os.getenv('TASK_DB_FLUSH_INTERVAL', '0.5'))
+TASK_DB_RETENTION = int(os.getenv('TASK_DB_RETENTION', str(24 * 3600)))
+
+# Coordination configuration
+COORDINATION_BACKEND = os.getenv('COORDINATION_BACKEND', 'memory')  # 'memory' or 'sqlite'
+COORDINATION_DB_PATH = os.getenv('COORDINATION_DB_PATH', 'sessions/coordination.db')
+COORDINATION_STALE_AFTER = float(os.getenv('COORDINATION_STALE_AFTER', '0'))  # 0 derives it from the task timeouts
+DISPATCH_INTERVAL = float(os.getenv('DISPATCH_INTERVAL', '2'))
+
+# Backend client configuration
+BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', '10'))
+BACKEND_TOTAL_TIMEOUT = float(os.getenv('BACKEND_TOTAL_TIMEOUT', '30'))
+BACKEND_POOL_SIZE = int(os.getenv('BACKEND_POOL_SIZE', '100'))
+BACKEND_ENDPOINT_CONCURRENCY = int(os.getenv('BACKEND_ENDPOINT_CONCURRENCY', '8'))
+BACKEND_KEEPALIVE_TIMEOUT = float(os.getenv('BACKEND_KEEPALIVE_TIMEOUT', '60'))
+BACKEND_HEALTH_PATH = os.getenv('BACKEND_HEALTH_PATH', '/health')
+BACKEND_HEALTH_INTERVAL = float(os.getenv('BACKEND_HEALTH_INTERVAL', '15'))
+BACKEND_FAILURE_THRESHOLD = int(os.getenv('BACKEND_FAILURE_THRESHOLD', '3'))
+BACKEND_OPEN_SECONDS = float(os.getenv('BACKEND_OPEN_SECONDS', '30'))
+BACKEND_RETRIES = int(os.getenv('BACKEND_RETRIES', '2'))
+BACKEND_RETRY_BASE = float(os.getenv('BACKEND_RETRY_BASE', '0.5'))
+BACKEND_STATUS_PATH = os.getenv('BACKEND_STATUS_PATH', '')  # e.g. '/api/status/{task_id}'; empty disables polling
+BACKEND_BATCH_PATH = os.getenv('BACKEND_BATCH_PATH', '')  # e.g. '/api/generate/batch'; empty disables batching
+BATCH_WINDOW = float(os.getenv('BATCH_WINDOW', '0.25'))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '4'))
+
+# Webhook server configuration
+WEBHOOK_PORT = int(os.environ.get("PORT", 8080))
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(64 * 1024 * 1024)))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '4'))
+WEBHOOK_ACQUIRE_TIMEOUT = float(os.getenv('WEBHOOK_ACQUIRE_TIMEOUT', '60'))
+WEBHOOK_READ_CHUNK = 64 * 1024
+SHUTDOWN_GRACE = float(os.getenv('SHUTDOWN_GRACE', '30'))  # seconds stop() lets deliveries and sends finish
+
+# Outbound Telegram scheduler configuration
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '25'))
+SEND_GLOBAL_BURST = int(os.getenv('SEND_GLOBAL_BURST', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_UPLOAD_CONCURRENCY = int(os.getenv('SEND_UPLOAD_CONCURRENCY', '4'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+
+# Outbound priority lanes, served in this order
+PRIORITY_RESULT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+# Progress updates configuration
+PROGRESS_STATUSES = ('queued', 'progress', 'running', 'encoding')
+PROGRESS_MAX_BODY = int(os.getenv('PROGRESS_MAX_BODY', '16384'))
+PROGRESS_CHAT_INTERVAL = float(os.getenv('PROGRESS_CHAT_INTERVAL', '3'))
+PROGRESS_EDITS_PER_SECOND = float(os.getenv('PROGRESS_EDITS_PER_SECOND', '20'))
+PROGRESS_TICK = float(os.getenv('PROGRESS_TICK', '0.5'))
+
+# Metrics configuration
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.5'))
+LOOP_STALL_HISTORY = int(os.getenv('LOOP_STALL_HISTORY', '20'))
+PROFILER_SAMPLE_INTERVAL = float(os.getenv('PROFILER_SAMPLE_INTERVAL', '0.005'))
+
+ENDPOINT_PATHS = {
+    't2v': '/api/generate/t2v',
+    'i2v': '/api/generate/i2v',
+    'animate': '/api/generate/animate',
+    'camera': '/api/generate/camera-lora'
+}
+
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+    kind = 'counter'
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+    
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] += amount
+    
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, self.labelnames, labels, value
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = 'gauge'
+    
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+class Histogram:
+    """Histogram with fixed upper bounds; observe() is a bisect and three increments"""
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+    
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+    
+    def samples(self):
+        bucket_labelnames = self.labelnames + ('le',)
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", bucket_labelnames, labels + (repr(float(bound)),), cumulative
+            yield f"{self.name}_bucket", bucket_labelnames, labels + ('+Inf',), count
+            yield f"{self.name}_sum", self.labelnames, labels, total
+            yield f"{self.name}_count", self.labelnames, labels, count
+
+class MetricsRegistry:
+    """Process metrics rendered in the Prometheus text format
+
+    Metrics are only recorded from the event loop thread, so updates are
+    plain dict operations with no locking.
+    """
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+    
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        metric = Gauge(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labels, value in metric.samples():
+                if labelnames:
+                    label_text = ','.join(f'{key}="{self._escape(val)}"' for key, val in zip(labelnames, labels))
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram('bot_handler_seconds', 'Time spent handling a Telegram update', ('handler',))
+MEDIA_DOWNLOAD_LATENCY = metrics.histogram(
+    'bot_media_download_seconds', 'Time to download user media from Telegram', ('kind',)
+)
+MEDIA_DOWNLOAD_BYTES = metrics.counter('bot_media_download_bytes_total', 'Bytes downloaded from Telegram', ('kind',))
+BACKEND_SUBMIT_LATENCY = metrics.histogram(
+    'bot_backend_submit_seconds', 'Backend submit latency per attempt', ('endpoint',)
+)
+BACKEND_SUBMIT_TOTAL = metrics.counter(
+    'bot_backend_submits_total', 'Backend submit attempts by outcome', ('endpoint', 'status')
+)
+WEBHOOK_TOTAL = metrics.counter('bot_webhooks_total', 'Webhook calls by outcome', ('outcome',))
+DELIVERY_LATENCY = metrics.histogram(
+    'bot_delivery_seconds', 'Time from webhook arrival until the result was sent to every recipient'
+)
+UPLOAD_LATENCY = metrics.histogram('bot_upload_seconds', 'Time to upload a result video to Telegram')
+UPLOAD_BYTES = metrics.counter('bot_upload_bytes_total', 'Result video bytes uploaded to Telegram')
+FLOOD_WAITS = metrics.counter('bot_flood_waits_total', 'FloodWait errors returned by Telegram')
+OUTBOUND_QUEUED = metrics.gauge('bot_outbound_queued', 'Outbound Telegram calls waiting for a send slot', ('lane',))
+TASKS_EXPIRED = metrics.counter('bot_tasks_expired_total', 'Tasks given up on because no webhook arrived')
+REQUESTS_REJECTED = metrics.counter('bot_requests_rejected_total', 'Generate requests turned away', ('reason',))
+QUEUE_RUNNING = metrics.gauge('bot_queue_running', 'Tasks holding a backend slot')
+QUEUE_WAITING = metrics.gauge('bot_queue_waiting', 'Tasks held locally until a backend slot frees up')
+QUEUE_WAIT = metrics.histogram('bot_queue_wait_seconds', 'Time a task was held before going to the backend', ('tier',))
+LOOP_LAG = metrics.histogram(
+    'bot_event_loop_lag_seconds', 'Delay of a periodic timer on the event loop',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+BATCH_SIZE = metrics.histogram(
+    'bot_backend_batch_size', 'Jobs per backend submission request', buckets=(1, 2, 4, 8, 16, 32)
+)
+LOOP_STALLS = metrics.counter('bot_event_loop_stalls_total', 'Event loop stalls longer than the watchdog threshold')
+
+class ThroughputTracker:
+    """Per-minute task counters and a window of end-to-end times, updated as tasks move"""
+    def __init__(self, minutes: int = 60, samples: int = 1000):
+        self.buckets = deque(maxlen=minutes)
+        self.durations = deque(maxlen=samples)
+    
+    def _bucket(self) -> list:
+        minute = int(time.time() // 60)
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append([minute, 0, 0, 0])
+        return self.buckets[-1]
+    
+    def record_submitted(self):
+        self._bucket()[1] += 1
+    
+    def record_finished(self, completed: bool, duration: Optional[float] = None):
+        self._bucket()[2 if completed else 3] += 1
+        if completed and duration is not None:
+            self.durations.append(duration)
+    
+    def totals(self, minutes: int) -> tuple[int, int, int]:
+        """(submitted, completed, failed) over the last `minutes` minutes, including the current one"""
+        since = int(time.time() // 60) - minutes + 1
+        submitted = completed = failed = 0
+        for minute, bucket_submitted, bucket_completed, bucket_failed in reversed(self.buckets):
+            if minute < since:
+                break
+            submitted += bucket_submitted
+            completed += bucket_completed
+            failed += bucket_failed
+        return submitted, completed, failed
+    
+    def percentiles(self, *quantiles: float) -> list[Optional[float]]:
+        """End-to-end time quantiles over the recent window"""
+        ordered = sorted(self.durations)
+        if not ordered:
+            return [None] * len(quantiles)
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+
+class LoopWatchdog:
+    """Detects event loop stalls from a separate thread and optionally samples loop stacks
+
+    A heartbeat coroutine stamps the time on every tick. The watchdog thread
+    notices when the stamp goes stale, captures the loop thread's stack while
+    it is still blocked and names the registered handler on that stack. When
+    profiling is on, the same thread samples the loop stack every
+    sample_interval and aggregates identical stacks.
+    """
+    MAX_DEPTH = 64
+    
+    def __init__(self, interval: float, threshold: float, history: int, sample_interval: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.check_interval = min(interval, threshold) / 5
+        self.stalls = deque(maxlen=history)
+        self.entry_points = {}
+        self.last_beat = time.monotonic()
+        self.current_stall = None
+        self.loop_thread_id = None
+        self.loop = None
+        self.profiling = False
+        self.profile_started = 0.0
+        self.samples = StackCounter()
+        self.samples_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def register(self, *handlers):
+        """Name these functions when they are found on a blocked stack"""
+        for handler in handlers:
+            function = getattr(handler, '__func__', handler)
+            self.entry_points[function.__code__] = function.__name__
+    
+    def start(self):
+        """Start watching the event loop running in the calling thread"""
+        self.loop_thread_id = threading.get_ident()
+        self.loop = asyncio.get_running_loop()
+        self.last_beat = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+    
+    async def heartbeat(self):
+        """Stamp the loop's liveness and record how late each tick fires"""
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, time.monotonic() - self.last_beat - self.interval))
+    
+    def _loop_frame(self):
+        return sys._current_frames().get(self.loop_thread_id)
+    
+    def _handler_name(self, frame) -> Optional[str]:
+        """Outermost registered handler on the stack"""
+        name = None
+        while frame is not None:
+            name = self.entry_points.get(frame.f_code, name)
+            frame = frame.f_back
+        return name
+    
+    def _run(self):
+        while not self._stop.wait(self.sample_interval if self.profiling else self.check_interval):
+            if self.profiling:
+                self._sample()
+            
+            lag = time.monotonic() - self.last_beat - self.interval
+            if lag >= self.threshold and self.current_stall is None:
+                frame = self._loop_frame()
+                handler = self._handler_name(frame)
+                stack = ''.join(traceback.format_stack(frame)[-12:]) if frame else ''
+                self.current_stall = {
+                    'at': time.time() - lag,
+                    'handler': handler,
+                    'stack': stack,
+                    'duration': None
+                }
+                self.stalls.append(self.current_stall)
+                logger.warning(
+                    f"Event loop blocked for {lag:.2f}s in {handler or 'unknown handler'}\n{stack}"
+                )
+            elif lag < self.threshold and self.current_stall is not None:
+                self.current_stall['duration'] = time.time() - self.current_stall['at']
+                # Metrics are only touched from the loop thread
+                try:
+                    self.loop.call_soon_threadsafe(LOOP_STALLS.inc)
+                except RuntimeError:
+                    pass  # The loop closed during shutdown
+                logger.warning(f"Event loop unblocked after {self.current_stall['duration']:.2f}s")
+                self.current_stall = None
+    
+    def _sample(self):
+        frame = self._loop_frame()
+        names = []
+        while frame is not None and len(names) < self.MAX_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        if names:
+            with self.samples_lock:
+                self.samples[';'.join(reversed(names))] += 1
+    
+    def start_profiling(self):
+        with self.samples_lock:
+            self.samples.clear()
+        self.profile_started = time.monotonic()
+        self.profiling = True
+    
+    def stop_profiling(self):
+        self.profiling = False
+    
+    def profile_snapshot(self) -> tuple[StackCounter, float]:
+        """Aggregated samples and seconds profiled so far"""
+        with self.samples_lock:
+            return StackCounter(self.samples), time.monotonic() - self.profile_started
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` per second up to `capacity`"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, now: float, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+    
+    def take(self, amount: float = 1.0):
+        self.tokens -= amount
+    
+    def give(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+    
+    def idle(self) -> bool:
+        return self.tokens >= self.capacity
 
 class RateLimiter:
-    """Rate limiter for user requests"""
-    def __init__(self, max_requests: int, window_seconds: int):
-        self.max_requests = max_requests
+    """Per-user quotas in estimated GPU-seconds, one token bucket per user
+
+    A bucket holds up to `capacity` and refills at capacity / window per
+    second, so heavy jobs use up the quota faster than light ones. Buckets
+    are created when a user spends and swept once they are full again.
+    """
+    def __init__(self, capacity: float, window_seconds: int, sweep_interval: float = 600):
+        self.capacity = capacity
         self.window_seconds = window_seconds
-        self.requests = defaultdict(deque)
+        self.rate = capacity / window_seconds
+        self.sweep_interval = sweep_interval
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.last_sweep = time.monotonic()
     
-    def is_allowed(self, user_id: int) -> tuple[bool, Optional[int]]:
-        """Check if user is allowed to make request. Returns (allowed, seconds_until_reset)"""
-        now = datetime.now()
-        user_requests = self.requests[user_id]
+    def try_acquire(self, user_id: int, cost: float) -> tuple[bool, Optional[int]]:
+        """Check the quota and charge the cost in one step. Returns (allowed, seconds_until_enough)"""
+        now = time.monotonic()
+        if now - self.last_sweep > self.sweep_interval:
+            self.sweep(now)
         
-        # Remove old requests outside the window
-        while user_requests and (now - user_requests[0]).total_seconds() > self.window_seconds:
-            user_requests.popleft()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.capacity)
+            bucket.updated = now
+        # A job larger than the whole quota may run on a full bucket and leaves it in debt
+        wait = bucket.wait_time(now, min(cost, self.capacity))
+        if wait > 0:
+            return False, math.ceil(wait)
+        bucket.take(cost)
+        return True, None
+    
+    def add_request(self, user_id: int, cost: float, timestamp: Optional[float] = None):
+        """Charge a request unconditionally, e.g. when restoring state. Stamps must arrive in order"""
+        now = time.monotonic() if timestamp is None else timestamp
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.capacity)
+            bucket.updated = now
+        bucket.wait_time(now)
+        bucket.take(cost)
+    
+    def refund(self, user_id: int, cost: float):
+        """Give back a charged cost"""
+        bucket = self.buckets.get(user_id)
+        if bucket is not None:
+            bucket.give(cost)
+    
+    def get_remaining_quota(self, user_id: int) -> float:
+        """GPU-seconds the user can spend right now"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            return self.capacity
+        bucket.wait_time(time.monotonic())
+        return max(bucket.tokens, 0.0)
+    
+    def sweep(self, now: Optional[float] = None):
+        """Evict users whose bucket has refilled completely"""
+        now = time.monotonic() if now is None else now
+        self.last_sweep = now
+        full = [user_id for user_id, bucket in self.buckets.items() if bucket.wait_time(now) == 0 and bucket.idle()]
+        for user_id in full:
+            del self.buckets[user_id]
+
+def work_units(payload: Dict[str, Any]) -> float:
+    """Frames times steps, scaled by resolution relative to 832x480"""
+    units = payload.get('num_frames', 81) * payload.get('steps', 20)
+    pixels = payload.get('width', 832) * payload.get('height', 480) / (832 * 480)
+    return units * pixels
+
+class CostModel:
+    """Estimates a job's GPU-seconds from its work units, learned per mode
+
+    Each mode keeps its own seconds per unit: an EWMA of observed webhook
+    turnaround minus a fixed overhead. A single sample is clamped to 4x the
+    current value either way, so cold starts cannot swing the estimate.
+    """
+    def __init__(self, seconds_per_unit: float, overhead: float, learning_rate: float):
+        self.default = seconds_per_unit
+        self.overhead = overhead
+        self.learning_rate = learning_rate
+        self.per_unit = {}
+        self.samples = defaultdict(int)
+    
+    def estimate(self, mode: str, payload: Dict[str, Any]) -> float:
+        """Estimated GPU-seconds for a payload"""
+        return self.overhead + self.per_unit.get(mode, self.default) * work_units(payload)
+    
+    def observe(self, mode: str, units: float, seconds: float):
+        """Learn from a finished job's turnaround"""
+        if units <= 0:
+            return
+        current = self.per_unit.get(mode, self.default)
+        sample = min(max(max(seconds - self.overhead, 0.0) / units, current / 4), current * 4)
+        self.per_unit[mode] = current + self.learning_rate * (sample - current)
+        self.samples[mode] += 1
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            mode: {'seconds_per_unit': round(self.per_unit.get(mode, self.default), 5), 'samples': self.samples[mode]}
+            for mode in ENDPOINT_PATHS
+        }
+
+class Tier:
+    """Scheduling class of a user: round-robin weight, concurrent task cap and share of the holding queue"""
+    __slots__ = ('name', 'weight', 'max_tasks', 'held_share')
+    
+    def __init__(self, name: str, weight: float, max_tasks: int, held_share: float):
+        self.name = name
+        self.weight = weight
+        self.max_tasks = max_tasks
+        self.held_share = held_share
+
+class Flow:
+    """One user's held tasks and their round-robin credit"""
+    __slots__ = ('tier', 'tasks', 'deficit')
+    
+    def __init__(self, tier: Tier):
+        self.tier = tier
+        self.tasks = deque()
+        self.deficit = 0.0
+
+class TaskQueue:
+    """Tasks held until the backend has a free slot, released by weighted deficit round-robin
+
+    Every user with held tasks is a flow. On its turn a flow earns its
+    tier's weight in credit and releases tasks while the credit covers
+    their cost, so a burst from one user cannot starve others and higher
+    tiers get proportionally more slots. Holding, releasing and picking
+    the next task are O(1) amortized. Backend slots themselves are counted
+    by the coordinator, so replicas share max_global.
+    """
+    def __init__(self, max_global: int, max_waiting: int, duration_estimate: float):
+        self.max_global = max_global
+        self.max_waiting = max_waiting
+        self.waiting = OrderedDict()
+        self.held = {}
+        self.flows = OrderedDict()
+        self.turn = None
+        self.held_by_tier = defaultdict(int)
+        self.started_at = {}
+        self.avg_duration = duration_estimate
+    
+    def is_full(self, tier: Optional[Tier] = None) -> bool:
+        """Check if no more tasks can be held, overall or for users of this tier"""
+        if len(self.waiting) >= self.max_waiting:
+            return True
+        return tier is not None and self.held_by_tier[tier.name] >= tier.held_share * self.max_waiting
+    
+    def hold(self, task_id: str, user_id: int, tier: Tier, cost: float = 1.0):
+        """Hold a task until a backend slot frees up"""
+        self.waiting[task_id] = user_id
+        self.held[task_id] = (cost, time.monotonic())
+        flow = self.flows.get(user_id)
+        if flow is None:
+            flow = self.flows[user_id] = Flow(tier)
+        flow.tasks.append(task_id)
+        self.held_by_tier[tier.name] += 1
+    
+    def peek(self) -> Optional[tuple[str, int]]:
+        """Next held task as (task_id, user_id), without removing it"""
+        visited, earned = 0, False
+        while self.flows:
+            user_id, flow = next(iter(self.flows.items()))
+            earned = earned or flow.tier.weight > 0
+            if self.turn != user_id:
+                flow.deficit += flow.tier.weight
+                self.turn = user_id
+            task_id = flow.tasks[0]
+            if flow.deficit >= self.held[task_id][0]:
+                return task_id, user_id
+            self.turn = None
+            self.flows.move_to_end(user_id)
+            visited += 1
+            if visited >= len(self.flows):
+                # A whole pass without credit would never release anything
+                if not earned:
+                    logger.error("No tier weight is positive; held tasks cannot be released")
+                    return None
+                visited, earned = 0, False
+        return None
+    
+    def _remove(self, task_id: str, charge: bool) -> bool:
+        user_id = self.waiting.pop(task_id, None)
+        if user_id is None:
+            return False
+        cost, held_at = self.held.pop(task_id)
+        flow = self.flows[user_id]
+        if flow.tasks[0] == task_id:
+            flow.tasks.popleft()
+        else:
+            flow.tasks.remove(task_id)
+        self.held_by_tier[flow.tier.name] -= 1
+        if charge:
+            flow.deficit -= cost
+            QUEUE_WAIT.observe(time.monotonic() - held_at, flow.tier.name)
+        if not flow.tasks:
+            # An idle flow keeps no credit, as in plain deficit round-robin
+            del self.flows[user_id]
+            if self.turn == user_id:
+                self.turn = None
+        return True
+    
+    def discard(self, task_id: str) -> bool:
+        """Drop a held task. Returns True if it was held"""
+        return self._remove(task_id, charge=False)
+    
+    def mark_started(self, task_id: str):
+        """Record that a task was sent to the backend, charging its cost to the user's flow"""
+        self._remove(task_id, charge=True)
+        self.started_at[task_id] = time.monotonic()
+    
+    def mark_finished(self, task_id: str, completed: bool) -> Optional[float]:
+        """Record a finished task, updating the duration estimate on success. Returns the successful run time"""
+        started = self.started_at.pop(task_id, None)
+        if completed and started is not None:
+            duration = time.monotonic() - started
+            self.avg_duration += 0.2 * (duration - self.avg_duration)
+            return duration
+        return None
+    
+    def order(self) -> list[tuple[str, int]]:
+        """Held tasks as (task_id, user_id) in the order they would be released if nothing else arrived"""
+        ring = deque([user_id, flow.tier.weight, flow.deficit, deque(flow.tasks)] for user_id, flow in self.flows.items())
+        turn = self.turn
+        released = []
+        visited, earned = 0, False
+        while ring:
+            entry = ring[0]
+            earned = earned or entry[1] > 0
+            if turn != entry[0]:
+                entry[2] += entry[1]
+                turn = entry[0]
+            cost = self.held[entry[3][0]][0]
+            if entry[2] >= cost:
+                entry[2] -= cost
+                released.append((entry[3].popleft(), entry[0]))
+                visited, earned = 0, False
+                if entry[3]:
+                    continue
+                ring.popleft()
+            else:
+                ring.rotate(-1)
+                visited += 1
+                if visited >= len(ring):
+                    if not earned:
+                        released.extend((task_id, user_id) for user_id, _, _, tasks in ring for task_id in tasks)
+                        break
+                    visited, earned = 0, False
+            turn = None
+        return released
+    
+    def get_position(self, task_id: str) -> Optional[int]:
+        """Position among held tasks (1 = next to run), or None if not held"""
+        if task_id not in self.waiting:
+            return None
+        for position, (waiting_id, user_id) in enumerate(self.order(), 1):
+            if waiting_id == task_id:
+                return position
+        return None
+    
+    def estimate_start(self, position: int) -> float:
+        """Estimated seconds until a held task at this position starts"""
+        if position <= 0:
+            return 0.0
+        return math.ceil(position / max(self.max_global, 1)) * self.avg_duration
+
+def task_timeout(payload: Dict[str, Any]) -> float:
+    """Seconds to wait for a task's webhook, scaled by frames, steps and resolution"""
+    return TASK_TIMEOUT_BASE + TASK_TIMEOUT_PER_UNIT * work_units(payload)
+
+class TaskDeadlines:
+    """Min-heap of task deadlines with lazy removal
+
+    Scheduling and popping are O(log n). Rescheduling or cancelling only
+    updates the dict; stale heap entries are skipped when they surface.
+    """
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+    
+    def schedule(self, task_id: str, deadline: float, extensions: int = 0):
+        self.deadlines[task_id] = (deadline, extensions)
+        heapq.heappush(self.heap, (deadline, task_id))
+    
+    def cancel(self, task_id: str):
+        self.deadlines.pop(task_id, None)
+    
+    def postpone(self, task_id: str, deadline: float):
+        """Move a scheduled deadline later, keeping its extension count"""
+        current = self.deadlines.get(task_id)
+        if current is not None and current[0] < deadline:
+            self.schedule(task_id, deadline, current[1])
+    
+    def pop_expired(self, now: float) -> list[tuple[str, int]]:
+        """Remove and return (task_id, extensions) for every deadline at or before now"""
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, task_id = heapq.heappop(self.heap)
+            current = self.deadlines.get(task_id)
+            if current is not None and current[0] == deadline:
+                del self.deadlines[task_id]
+                expired.append((task_id, current[1]))
+        return expired
+    
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+class TaskRef:
+    """A task as known to the coordinator"""
+    __slots__ = ('task_id', 'user_id', 'chat_id', 'cache_key', 'leader_id', 'submitted_at', 'cost')
+    
+    def __init__(self, task_id: str, user_id: int, chat_id: int, cache_key: Optional[str] = None,
+                 leader_id: Optional[str] = None, submitted_at: Optional[float] = None, cost: float = 0.0):
+        self.task_id = task_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.cache_key = cache_key
+        self.leader_id = leader_id
+        self.submitted_at = submitted_at if submitted_at is not None else time.time()
+        self.cost = cost
+
+class MemoryCoordinator:
+    """Coordination state for a single replica, kept in process memory
+
+    Holds the user quotas and global capacity bucket, per-user and backend
+    slots, and the map from task ids to chats (including requests coalesced
+    onto a leader task).
+    """
+    shared = False
+    
+    def __init__(self, rate_limiter: RateLimiter, capacity: TokenBucket):
+        self.rate_limiter = rate_limiter
+        self.capacity = capacity
+        self.user_tasks = {}
+        self.backend_tasks = set()
+        self.tasks = {}
+        self.followers = {}
+        self.inflight = {}
+    
+    async def acquire_request(self, user_id: int, cost: float) -> tuple[bool, Optional[int]]:
+        """Check and charge a user's quota. Returns (allowed, seconds_until_enough)"""
+        return self.rate_limiter.try_acquire(user_id, cost)
+    
+    async def refund_request(self, user_id: int, cost: float):
+        self.rate_limiter.refund(user_id, cost)
+    
+    async def remaining_quota(self, user_id: int) -> float:
+        return self.rate_limiter.get_remaining_quota(user_id)
+    
+    def restore_request(self, user_id: int, submitted_at: float, cost: float):
+        """Replay a wall-clock submission into the limiter"""
+        self.rate_limiter.add_request(user_id, cost, submitted_at + time.monotonic() - time.time())
+    
+    async def acquire_capacity(self, cost: float) -> bool:
+        """Admit a job's cost against the backend's global GPU budget"""
+        if self.capacity.wait_time(time.monotonic(), min(cost, self.capacity.capacity)) > 0:
+            return False
+        self.capacity.take(cost)
+        return True
+    
+    async def refund_capacity(self, cost: float):
+        self.capacity.give(cost)
+    
+    async def remaining_capacity(self) -> float:
+        self.capacity.wait_time(time.monotonic())
+        return max(self.capacity.tokens, 0.0)
+    
+    async def acquire_user_slot(self, user_id: int, limit: float) -> bool:
+        if self.user_tasks.get(user_id, 0) >= limit:
+            return False
+        self.user_tasks[user_id] = self.user_tasks.get(user_id, 0) + 1
+        return True
+    
+    async def release_user_slot(self, user_id: int):
+        if self.user_tasks.get(user_id, 0) > 1:
+            self.user_tasks[user_id] -= 1
+        else:
+            self.user_tasks.pop(user_id, None)
+    
+    async def user_slots(self, user_id: int) -> int:
+        return self.user_tasks.get(user_id, 0)
+    
+    async def acquire_backend_slot(self, task_id: str, limit: float) -> bool:
+        if task_id not in self.backend_tasks and len(self.backend_tasks) >= limit:
+            return False
+        self.backend_tasks.add(task_id)
+        return True
+    
+    async def release_backend_slot(self, task_id: str) -> bool:
+        if task_id in self.backend_tasks:
+            self.backend_tasks.discard(task_id)
+            return True
+        return False
+    
+    async def backend_slots(self) -> int:
+        return len(self.backend_tasks)
+    
+    async def register_task(self, task: TaskRef) -> bool:
+        """Register a task. A follower is only registered while its leader is"""
+        if task.leader_id is not None:
+            leader = self.tasks.get(task.leader_id)
+            if leader is None or leader.leader_id is not None:
+                return False
+            self.followers.setdefault(task.leader_id, []).append(task.task_id)
+        elif task.cache_key:
+            self.inflight[task.cache_key] = task.task_id
+        self.tasks[task.task_id] = task
+        return True
+    
+    async def find_inflight(self, cache_key: str) -> Optional[str]:
+        return self.inflight.get(cache_key)
+    
+    async def is_registered(self, task_id: str) -> bool:
+        return task_id in self.tasks
+    
+    async def claim_task(self, task_id: str) -> Optional[tuple[TaskRef, list[TaskRef]]]:
+        """Remove a leader task and its followers so exactly one caller delivers them"""
+        task = self.tasks.pop(task_id, None)
+        if task is None:
+            return None
+        if task.cache_key and self.inflight.get(task.cache_key) == task_id:
+            del self.inflight[task.cache_key]
+        followers = [self.tasks.pop(follower_id) for follower_id in self.followers.pop(task_id, [])
+                     if follower_id in self.tasks]
+        return task, followers
+    
+    async def sweep(self):
+        self.rate_limiter.sweep()
+
+class SQLiteCoordinator:
+    """Coordination state shared by several replicas through one SQLite database
+
+    Every operation runs in a worker thread inside BEGIN IMMEDIATE, so each
+    check-and-update is atomic across processes. Token buckets are stamped
+    with wall-clock time because monotonic clocks are not comparable between
+    processes.
+    """
+    shared = True
+    
+    def __init__(self, path: str, user_budget: float, window_seconds: int, capacity_rate: float,
+                 capacity_burst: float, stale_after: float):
+        self.path = path
+        self.stale_after = stale_after
+        self.user_budget = user_budget
+        self.user_rate = user_budget / window_seconds
+        self.capacity_rate = capacity_rate
+        self.capacity_burst = capacity_burst
+        self.local = threading.local()
         
-        if len(user_requests) >= self.max_requests:
-            oldest_request = user_requests[0]
-            seconds_until_reset = int(self.window_seconds - (now - oldest_request).total_seconds())
-            return False, seconds_until_reset
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS quota_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS user_slots (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS backend_slots (task_id TEXT PRIMARY KEY, acquired_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS task_map ("
+            " task_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER,"
+            " cache_key TEXT, leader_id TEXT, created_at REAL NOT NULL, cost REAL NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS idx_task_map_key ON task_map (cache_key);"
+            "CREATE INDEX IF NOT EXISTS idx_task_map_leader ON task_map (leader_id);"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(task_map)")}
+        if 'cost' not in columns:
+            conn.execute("ALTER TABLE task_map ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+    
+    def _conn(self) -> sqlite3.Connection:
+        """Per-thread connection in autocommit mode; transactions are explicit"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+    
+    def _transaction(self, operation, *args):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = operation(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+    
+    async def _run(self, operation, *args):
+        return await asyncio.to_thread(self._transaction, operation, *args)
+    
+    def _level(self, conn, key: str, capacity: float, rate: float, now: float) -> float:
+        row = conn.execute("SELECT tokens, updated FROM quota_buckets WHERE key = ?", (key,)).fetchone()
+        return capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+    
+    def _store(self, conn, key: str, tokens: float, now: float):
+        conn.execute(
+            "INSERT INTO quota_buckets (key, tokens, updated) VALUES (?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+            (key, tokens, now)
+        )
+    
+    def _take(self, conn, key: str, capacity: float, rate: float, cost: float, now: float) -> float:
+        """Take `cost` from a bucket; returns 0 if taken, else seconds until it could be"""
+        level = self._level(conn, key, capacity, rate, now)
+        needed = min(cost, capacity)
+        if level < needed:
+            return (needed - level) / rate
+        self._store(conn, key, level - cost, now)
+        return 0.0
+    
+    def _give(self, conn, key: str, capacity: float, rate: float, amount: float, now: float):
+        self._store(conn, key, min(capacity, self._level(conn, key, capacity, rate, now) + amount), now)
+    
+    async def acquire_request(self, user_id: int, cost: float) -> tuple[bool, Optional[int]]:
+        """Check and charge a user's quota. Returns (allowed, seconds_until_enough)"""
+        def operation(conn, now):
+            wait = self._take(conn, str(user_id), self.user_budget, self.user_rate, cost, now)
+            return (True, None) if wait == 0 else (False, math.ceil(wait))
+        return await self._run(operation, time.time())
+    
+    async def refund_request(self, user_id: int, cost: float):
+        def operation(conn, now):
+            self._give(conn, str(user_id), self.user_budget, self.user_rate, cost, now)
+        await self._run(operation, time.time())
+    
+    async def remaining_quota(self, user_id: int) -> float:
+        def operation(conn, now):
+            return max(self._level(conn, str(user_id), self.user_budget, self.user_rate, now), 0.0)
+        return await self._run(operation, time.time())
+    
+    async def acquire_capacity(self, cost: float) -> bool:
+        """Admit a job's cost against the backend's global GPU budget, shared by all replicas"""
+        def operation(conn, now):
+            return self._take(conn, 'global', self.capacity_burst, self.capacity_rate, cost, now) == 0
+        return await self._run(operation, time.time())
+    
+    async def refund_capacity(self, cost: float):
+        def operation(conn, now):
+            self._give(conn, 'global', self.capacity_burst, self.capacity_rate, cost, now)
+        await self._run(operation, time.time())
+    
+    async def remaining_capacity(self) -> float:
+        def operation(conn, now):
+            return max(self._level(conn, 'global', self.capacity_burst, self.capacity_rate, now), 0.0)
+        return await self._run(operation, time.time())
+    
+    async def acquire_user_slot(self, user_id: int, limit: float) -> bool:
+        def operation(conn):
+            row = conn.execute("SELECT count FROM user_slots WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None and row[0] >= limit:
+                return False
+            conn.execute(
+                "INSERT INTO user_slots (user_id, count) VALUES (?, 1)"
+                " ON CONFLICT(user_id) DO UPDATE SET count = count + 1",
+                (user_id,)
+            )
+            return True
+        return await self._run(operation)
+    
+    async def release_user_slot(self, user_id: int):
+        def operation(conn):
+            conn.execute("UPDATE user_slots SET count = count - 1 WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM user_slots WHERE user_id = ? AND count <= 0", (user_id,))
+        await self._run(operation)
+    
+    async def user_slots(self, user_id: int) -> int:
+        def operation(conn):
+            row = conn.execute("SELECT count FROM user_slots WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0] if row else 0
+        return await self._run(operation)
+    
+    async def acquire_backend_slot(self, task_id: str, limit: float) -> bool:
+        def operation(conn):
+            if conn.execute("SELECT 1 FROM backend_slots WHERE task_id = ?", (task_id,)).fetchone():
+                return True
+            (count,) = conn.execute("SELECT COUNT(*) FROM backend_slots").fetchone()
+            if count >= limit:
+                return False
+            conn.execute("INSERT INTO backend_slots (task_id, acquired_at) VALUES (?, ?)", (task_id, time.time()))
+            return True
+        return await self._run(operation)
+    
+    async def release_backend_slot(self, task_id: str) -> bool:
+        def operation(conn):
+            return conn.execute("DELETE FROM backend_slots WHERE task_id = ?", (task_id,)).rowcount > 0
+        return await self._run(operation)
+    
+    async def backend_slots(self) -> int:
+        def operation(conn):
+            return conn.execute("SELECT COUNT(*) FROM backend_slots").fetchone()[0]
+        return await self._run(operation)
+    
+    async def register_task(self, task: TaskRef) -> bool:
+        """Register a task. A follower is only registered while its leader is"""
+        def operation(conn):
+            values = (
+                task.task_id, task.user_id, task.chat_id, task.cache_key, task.leader_id, task.submitted_at, task.cost
+            )
+            if task.leader_id is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO task_map (task_id, user_id, chat_id, cache_key, leader_id, created_at, cost)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)", values
+                )
+                return True
+            return conn.execute(
+                "INSERT INTO task_map (task_id, user_id, chat_id, cache_key, leader_id, created_at, cost)"
+                " SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS"
+                " (SELECT 1 FROM task_map WHERE task_id = ? AND leader_id IS NULL)",
+                values + (task.leader_id,)
+            ).rowcount > 0
+        return await self._run(operation)
+    
+    async def find_inflight(self, cache_key: str) -> Optional[str]:
+        def operation(conn):
+            row = conn.execute(
+                "SELECT task_id FROM task_map WHERE cache_key = ? AND leader_id IS NULL LIMIT 1", (cache_key,)
+            ).fetchone()
+            return row[0] if row else None
+        return await self._run(operation)
+    
+    async def is_registered(self, task_id: str) -> bool:
+        def operation(conn):
+            return conn.execute("SELECT 1 FROM task_map WHERE task_id = ?", (task_id,)).fetchone() is not None
+        return await self._run(operation)
+    
+    async def claim_task(self, task_id: str) -> Optional[tuple[TaskRef, list[TaskRef]]]:
+        """Remove a leader task and its followers so exactly one replica delivers them"""
+        def operation(conn):
+            columns = "task_id, user_id, chat_id, cache_key, leader_id, created_at, cost"
+            row = conn.execute(f"SELECT {columns} FROM task_map WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return None
+            followers = conn.execute(f"SELECT {columns} FROM task_map WHERE leader_id = ?", (task_id,)).fetchall()
+            conn.execute("DELETE FROM task_map WHERE task_id = ? OR leader_id = ?", (task_id, task_id))
+            return TaskRef(*row), [TaskRef(*follower) for follower in followers]
+        return await self._run(operation)
+    
+    async def sweep(self):
+        """Drop full quota buckets and rows left behind by replicas that died mid-task"""
+        def operation(conn, now):
+            conn.execute(
+                "DELETE FROM quota_buckets WHERE key != 'global' AND tokens + (? - updated) * ? >= ?",
+                (now, self.user_rate, self.user_budget)
+            )
+            # A live replica delivers or expires its tasks well before this, so older rows have no owner
+            cutoff = now - self.stale_after
+            stale = conn.execute(
+                "SELECT task_id, user_id FROM task_map WHERE created_at < ?"
+                " OR leader_id IN (SELECT task_id FROM task_map WHERE created_at < ?)",
+                (cutoff, cutoff)
+            ).fetchall()
+            for task_id, user_id in stale:
+                conn.execute("DELETE FROM task_map WHERE task_id = ?", (task_id,))
+                conn.execute("DELETE FROM backend_slots WHERE task_id = ?", (task_id,))
+                conn.execute("UPDATE user_slots SET count = count - 1 WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM user_slots WHERE count <= 0")
+            slots = conn.execute("DELETE FROM backend_slots WHERE acquired_at < ?", (cutoff,)).rowcount
+            return len(stale), slots
+        tasks, slots = await self._run(operation, time.time())
+        if tasks or slots:
+            logger.warning(f"Expired {tasks} orphaned task(s) and {slots} more backend slot(s) from the coordination database")
+
+class TaskStore:
+    """Durable task registry in SQLite (WAL mode)
+
+    Writes are queued from the event loop and committed in batches by a
+    background thread; reads, and marking tasks lost in a restart, only happen
+    synchronously at startup.
+    """
+    MAX_BATCH = 500
+    
+    def __init__(self, path: str, flush_interval: float, retention: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.ops = queue.Queue()
         
-        return True, None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " task_id TEXT PRIMARY KEY,"
+                " user_id INTEGER NOT NULL,"
+                " chat_id INTEGER,"
+                " mode TEXT,"
+                " submitted_at REAL NOT NULL,"
+                " status TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " leader_id TEXT,"
+                " cost REAL NOT NULL DEFAULT 0,"
+                " refunded INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+            if 'leader_id' not in columns:
+                conn.execute("ALTER TABLE tasks ADD COLUMN leader_id TEXT")
+            if 'cost' not in columns:
+                conn.execute("ALTER TABLE tasks ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+            if 'refunded' not in columns:
+                conn.execute("ALTER TABLE tasks ADD COLUMN refunded INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_submitted ON tasks (submitted_at)")
+        self._prune(conn)
+        conn.close()
+        
+        self.writer = threading.Thread(target=self._write_loop, name='task-store-writer', daemon=True)
+        self.writer.start()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection configured for WAL with relaxed fsync"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def record_submit(self, task_id: str, user_id: int, chat_id: int, mode: str, submitted_at: float,
+                      status: str = 'submitting', leader_id: Optional[str] = None, cost: float = 0.0):
+        """Queue the insertion of a new task"""
+        self.ops.put((
+            "INSERT OR REPLACE INTO tasks"
+            " (task_id, user_id, chat_id, mode, submitted_at, status, updated_at, leader_id, cost)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, user_id, chat_id, mode, submitted_at, status, submitted_at, leader_id, cost)
+        ))
+    
+    def update_status(self, task_id: str, status: str):
+        """Queue a status change for a task"""
+        self.ops.put((
+            "UPDATE tasks SET status = ?, updated_at = ? WHERE task_id = ?",
+            (status, time.time(), task_id)
+        ))
+    
+    def mark_refunded(self, task_id: str):
+        """Queue a note that a task's quota charge was given back"""
+        self.ops.put(("UPDATE tasks SET refunded = 1 WHERE task_id = ?", (task_id,)))
+    
+    def fail_unsent(self, task_ids: list[str]):
+        """Mark tasks that never reached the backend as failed and refunded, bypassing the write queue"""
+        if not task_ids:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE tasks SET status = 'failed', refunded = 1, updated_at = ? WHERE task_id = ?",
+                    [(now, task_id) for task_id in task_ids]
+                )
+        finally:
+            conn.close()
+    
+    def load_pending(self) -> list[tuple[str, int, int, str, float, str, Optional[str], float]]:
+        """Unfinished tasks: (task_id, user_id, chat_id, mode, submitted_at, status, leader_id, cost)"""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT task_id, user_id, chat_id, mode, submitted_at, status, leader_id, cost FROM tasks"
+                " WHERE status IN ('queued', 'submitting', 'pending') ORDER BY submitted_at"
+            ).fetchall()
+        finally:
+            conn.close()
+    
+    def load_requests_since(self, since: float) -> list[tuple[int, float, float]]:
+        """Charged submissions since a wall-clock timestamp: (user_id, submitted_at, cost)
+
+        Refunded tasks are left out, so a restart does not charge them again.
+        """
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT user_id, submitted_at, cost FROM tasks WHERE submitted_at >= ? AND refunded = 0"
+                " ORDER BY submitted_at",
+                (since,)
+            ).fetchall()
+        finally:
+            conn.close()
+    
+    def close(self):
+        """Flush queued writes and stop the writer thread"""
+        self.ops.put(None)
+        self.writer.join()
+    
+    def _prune(self, conn: sqlite3.Connection):
+        """Delete finished tasks older than the retention period"""
+        with conn:
+            conn.execute(
+                "DELETE FROM tasks WHERE status NOT IN ('queued', 'submitting', 'pending') AND submitted_at < ?",
+                (time.time() - self.retention,)
+            )
+    
+    def _write_loop(self):
+        """Commit queued writes in batches until close() is called"""
+        conn = self._connect()
+        last_prune = time.monotonic()
+        running = True
+        while running:
+            op = self.ops.get()
+            if op is None:
+                break
+            batch = [op]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    op = self.ops.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if op is None:
+                    running = False
+                    break
+                batch.append(op)
+            
+            try:
+                with conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error(f"Task store write failed ({len(batch)} ops): {e}")
+            
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                try:
+                    self._prune(conn)
+                except sqlite3.Error as e:
+                    logger.error(f"Task store prune failed: {e}")
+        conn.close()
+
+def remove_file(path: str):
+    """Delete a spooled file, ignoring files that are already gone"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove file {path}: {e}")
+
+async def finish_or_cancel(tasks, timeout: float):
+    """Wait up to timeout seconds for tasks, then cancel and reap the rest"""
+    tasks = list(tasks)
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+class MediaFile:
+    """User media spooled to disk, encoded to base64 only when submitted"""
+    def __init__(self, path: str, size: int, mime_type: Optional[str] = None, sha256: Optional[str] = None):
+        self.path = path
+        self.size = size
+        self.mime_type = mime_type
+        self.sha256 = sha256
+    
+    @property
+    def base64_size(self) -> int:
+        """Length of the base64 encoding of this file"""
+        return 4 * ((self.size + 2) // 3)
+    
+    async def iter_base64(self) -> AsyncIterator[bytes]:
+        """Yield the file as base64 chunks without loading it whole"""
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, MEDIA_READ_CHUNK)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+    
+    def discard(self):
+        """Delete the spooled file"""
+        remove_file(self.path)
+
+def preprocess_image(src_path: str, dst_base: str, width: int, height: int, quality: int) -> tuple[str, str]:
+    """Decode, apply EXIF orientation, downscale to just cover width x height and re-encode
+
+    The aspect ratio is kept so framing is still decided by the backend.
+    Blocking; run it in a worker thread. Returns (path, mime_type).
+    """
+    with Image.open(src_path) as source:
+        image = ImageOps.exif_transpose(source)
+        scale = max(width / image.width, height / image.height)
+        if scale < 1:
+            size = (max(width, round(image.width * scale)), max(height, round(image.height * scale)))
+            image = image.resize(size, Image.Resampling.LANCZOS)
+        
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        if has_alpha:
+            path = dst_base + '.webp'
+            image.convert('RGBA').save(path, 'WEBP', quality=quality, method=4)
+            return path, 'image/webp'
+        path = dst_base + '.jpg'
+        image.convert('RGB').save(path, 'JPEG', quality=quality, optimize=True)
+        return path, 'image/jpeg'
+
+def file_sha256(path: str) -> str:
+    """Hash a file in chunks. Blocking; run it in a thread"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def result_cache_key(mode: str, payload: Dict[str, Any]) -> str:
+    """Hash of the normalized generation request; media contributes its content hash"""
+    normalized = {'mode': mode}
+    for key, value in payload.items():
+        if key in ('task_id', 'webhook_url'):
+            continue
+        if isinstance(value, MediaFile):
+            normalized[key] = value.sha256
+        elif isinstance(value, str):
+            normalized[key] = ' '.join(value.split())
+        elif isinstance(value, float):
+            normalized[key] = round(value, 4)
+        else:
+            normalized[key] = value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+def discard_media(data: Dict[str, Any]):
+    """Delete every MediaFile referenced by a payload or wizard data dict"""
+    for value in data.values():
+        if isinstance(value, MediaFile):
+            value.discard()
+
+class JsonMediaPayload:
+    """JSON request body that streams attached MediaFile values as base64 strings"""
+    def __init__(self, payload: Dict[str, Any]):
+        self.fields = {k: v for k, v in payload.items() if not isinstance(v, MediaFile)}
+        self.media = {k: v for k, v in payload.items() if isinstance(v, MediaFile)}
+        self._head = json.dumps(self.fields).encode('utf-8')[:-1]
+        self._media_prefixes = []
+        separator = ', ' if self.fields else ''
+        for key in self.media:
+            self._media_prefixes.append(f'{separator}{json.dumps(key)}: "'.encode('utf-8'))
+            separator = ', '
+    
+    @property
+    def content_length(self) -> int:
+        """Exact size of the encoded body in bytes"""
+        size = len(self._head) + 1
+        for prefix, media in zip(self._media_prefixes, self.media.values()):
+            size += len(prefix) + media.base64_size + 1
+        return size
+    
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Yield the encoded body. Each call starts a fresh stream"""
+        yield self._head
+        for prefix, media in zip(self._media_prefixes, self.media.values()):
+            yield prefix
+            async for chunk in media.iter_base64():
+                yield chunk
+            yield b'"'
+        yield b'}'
+
+class JsonBatchPayload:
+    """Batch request body {"mode": ..., "jobs": [...]} streaming each job like JsonMediaPayload"""
+    def __init__(self, mode: str, payloads: list[Dict[str, Any]]):
+        self.jobs = [JsonMediaPayload(payload) for payload in payloads]
+        self._head = f'{{"mode": {json.dumps(mode)}, "jobs": ['.encode('utf-8')
+    
+    @property
+    def content_length(self) -> int:
+        """Exact size of the encoded body in bytes"""
+        return len(self._head) + sum(job.content_length for job in self.jobs) + 2 * (len(self.jobs) - 1) + 2
+    
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Yield the encoded body. Each call starts a fresh stream"""
+        yield self._head
+        for index, job in enumerate(self.jobs):
+            if index:
+                yield b', '
+            async for chunk in job.chunks():
+                yield chunk
+        yield b']}'
+
+class Step(Enum):
+    """Wizard steps. A session's state is its mode plus one of these"""
+    MENU = 'menu'
+    CAMERA_MOTION = 'camera_motion'
+    IMAGE = 'image'
+    REFERENCE = 'reference'
+    VIDEO = 'video'
+    PROMPT = 'prompt'
+    NEGATIVE = 'negative'
+
+class Callback(Enum):
+    """Inline button actions; the values double as handler metric labels"""
+    MAIN_MENU = 'main_menu'
+    T2V = 't2v'
+    I2V = 'i2v'
+    ANIMATE = 'animate'
+    CAMERA = 'camera'
+    CAMERA_MOTION = 'camera_motion'
+    HELP = 'help'
+    CANCEL = 'cancel'
+    GENERATE = 'generate'
+
+class Wizard:
+    """Steps, intro text and default parameters of one generation mode"""
+    __slots__ = ('mode', 'title', 'intro', 'steps', 'defaults', 'transitions')
+    
+    def __init__(self, mode: str, title: str, intro: str, steps: tuple, defaults: Dict[str, Any]):
+        self.mode = mode
+        self.title = title
+        self.intro = intro
+        self.steps = steps
+        self.defaults = defaults
+        self.transitions = dict(zip(steps, steps[1:]))
+    
+    def new_data(self) -> Dict[str, Any]:
+        """Fresh session data for this mode"""
+        return {'type': self.mode, 'prompt': '', 'negative_prompt': '', **self.defaults}
+
+WIZARDS = {
+    't2v': Wizard(
+        't2v', '📝 **Text to Video**',
+        'Send me a descriptive prompt for your video.\n\nExample: `A beautiful sunset over the ocean with waves gently crashing`',
+        (Step.PROMPT, Step.NEGATIVE),
+        {'width': 832, 'height': 480, 'num_frames': 121, 'steps': 30, 'cfg': 7.5, 'use_fast_mode': False}
+    ),
+    'i2v': Wizard(
+        'i2v', '🖼️ **Image to Video**',
+        'Please send me an image that you want to animate.\n\nSupported: JPG, PNG, WebP\nMax size: 20MB',
+        (Step.IMAGE, Step.PROMPT, Step.NEGATIVE),
+        {'width': 1280, 'height': 704, 'num_frames': 81, 'steps': 20, 'cfg': 3.5, 'use_fast_mode': True}
+    ),
+    'animate': Wizard(
+        'animate', '🎭 **Animate Character**',
+        'This transfers motion from a video to your character.\n\n**Step 1:** Send me a reference image of your character\n\nSupported: JPG, PNG, WebP\nMax size: 20MB',
+        (Step.REFERENCE, Step.VIDEO, Step.PROMPT, Step.NEGATIVE),
+        {'width': 640, 'height': 640, 'num_frames': 77, 'steps': 6, 'cfg': 1.0, 'use_fast_mode': True}
+    ),
+    'camera': Wizard(
+        'camera', '📹 **Camera Motion**',
+        'Select a camera motion to apply:',
+        (Step.CAMERA_MOTION, Step.IMAGE, Step.PROMPT, Step.NEGATIVE),
+        {'lora_strength': 1.0, 'image_base64': '', 'width': 1280, 'height': 704, 'num_frames': 81, 'steps': 20, 'cfg': 3.5}
+    )
+}
+
+# Steps that need an uploaded file, with the reminder sent when a message has none
+MEDIA_STEPS = {
+    Step.IMAGE: "📷 Please send an image!",
+    Step.REFERENCE: "📷 Please send an image!",
+    Step.VIDEO: "🎬 Please send a video!"
+}
+
+class Session:
+    """Wizard mode, step and collected inputs for one user"""
+    __slots__ = ('mode', 'step', 'data')
+    
+    def __init__(self, mode: Optional[str], step: Step, data: Optional[Dict[str, Any]] = None):
+        self.mode = mode
+        self.step = step
+        self.data = data if data is not None else {}
+    
+    def at(self, mode: Optional[str], step: Step) -> bool:
+        """Whether the wizard is still at this mode and step"""
+        return self.mode == mode and self.step is step
+    
+    def advance(self):
+        """Move to the next step of the mode's wizard"""
+        self.step = WIZARDS[self.mode].transitions[self.step]
+    
+    def size(self) -> int:
+        """Approximate bytes held, including attached media files"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.data)
+        for value in self.data.values():
+            size += value.size if isinstance(value, MediaFile) else sys.getsizeof(value)
+        return size
+    
+    def __getstate__(self):
+        return self.mode, self.step, self.data
+    
+    def __setstate__(self, state):
+        self.mode, self.step, self.data = state
+
+class MemorySessionBackend:
+    """Keeps sessions in process memory"""
+    def __init__(self):
+        self.sessions = {}
+    
+    def load(self, user_id: int) -> Optional[Session]:
+        return self.sessions.get(user_id)
+    
+    def save(self, user_id: int, session: Session):
+        self.sessions[user_id] = session
+    
+    def delete(self, user_id: int):
+        self.sessions.pop(user_id, None)
+
+class DiskSessionBackend:
+    """Pickles each session to its own small file so sessions live outside RAM
+
+    Writes and deletes are handed to a background thread, which applies
+    only the latest one per user; until it lands, load() answers from that
+    pending copy. Reads stay on the event loop: a session is a few hundred
+    bytes (media are spooled separately) and is normally in the page cache.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ops = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name='session-writer', daemon=True)
+        self.writer.start()
+    
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.directory, f"{user_id}.pkl")
+    
+    def load(self, user_id: int) -> Optional[Session]:
+        with self.lock:
+            if user_id in self.pending:
+                data = self.pending[user_id]
+                return None if data is None else pickle.loads(data)
+        try:
+            with open(self._path(user_id), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def save(self, user_id: int, session: Session):
+        # Pickle now so later changes to the session object are not written behind the caller's back
+        self._queue(user_id, pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+    
+    def delete(self, user_id: int):
+        self._queue(user_id, None)
+    
+    def _queue(self, user_id: int, data: Optional[bytes]):
+        with self.lock:
+            self.pending[user_id] = data
+        self.ops.put(user_id)
+    
+    def _write_loop(self):
+        """Apply queued writes; several queued for one user collapse into the latest"""
+        while True:
+            user_id = self.ops.get()
+            with self.lock:
+                if user_id not in self.pending:
+                    continue
+                data = self.pending[user_id]
+            path = self._path(user_id)
+            try:
+                if data is None:
+                    remove_file(path)
+                else:
+                    with open(path + '.tmp', 'wb') as f:
+                        f.write(data)
+                    os.replace(path + '.tmp', path)
+            except OSError as e:
+                # Keep the pending copy so the session still loads; the next save retries
+                logger.error(f"Could not write session of user {user_id}: {e}")
+                continue
+            with self.lock:
+                if user_id in self.pending and self.pending[user_id] is data:
+                    del self.pending[user_id]
+
+class SessionStore:
+    """Wizard sessions with an idle TTL and a global byte budget enforced by LRU eviction
+
+    The index (expiry and size per user) is always in memory and kept in
+    least-recently-used order; session bodies live in the pluggable backend.
+    Dropped sessions have their media files deleted.
+    """
+    def __init__(self, backend, ttl: float, budget: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.budget = budget
+        self.index = OrderedDict()
+        self.bytes_held = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, user_id: int) -> Optional[Session]:
+        """Get a live session and refresh its TTL"""
+        entry = self.index.get(user_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[0] <= now:
+            self._drop(user_id)
+            self.expirations += 1
+            return None
+        self.index[user_id] = (now + self.ttl, entry[1])
+        self.index.move_to_end(user_id)
+        return self.backend.load(user_id)
+    
+    def save(self, user_id: int, session: Session):
+        """Store a (possibly modified) session and re-account its size"""
+        size = session.size()
+        entry = self.index.pop(user_id, None)
+        if entry is not None:
+            self.bytes_held -= entry[1]
+        self.index[user_id] = (time.monotonic() + self.ttl, size)
+        self.bytes_held += size
+        self.backend.save(user_id, session)
+        
+        # Evict least recently used sessions, never the one just saved
+        while self.bytes_held > self.budget and len(self.index) > 1:
+            oldest = next(iter(self.index))
+            self._drop(oldest)
+            self.evictions += 1
+    
+    def start(self, user_id: int, mode: str, step: Step, data: Dict[str, Any]):
+        """Replace the user's session with a fresh one"""
+        self.clear(user_id)
+        self.save(user_id, Session(mode, step, data))
+    
+    def set_state(self, user_id: int, mode: Optional[str], step: Step):
+        """Move the user to a new state, keeping any collected data"""
+        session = self.get(user_id) or Session(mode, step)
+        session.mode = mode
+        session.step = step
+        self.save(user_id, session)
+    
+    def pop(self, user_id: int) -> Optional[Session]:
+        """Remove and return a session; the caller takes ownership of its media"""
+        session = self.get(user_id)
+        if session is not None:
+            self.bytes_held -= self.index.pop(user_id)[1]
+            self.backend.delete(user_id)
+        return session
+    
+    def clear(self, user_id: int):
+        """Drop a session and delete its media"""
+        if user_id in self.index:
+            self._drop(user_id)
+    
+    def sweep(self):
+        """Drop expired sessions. The index is in expiry order, so this stops at the first live one"""
+        now = time.monotonic()
+        while self.index:
+            user_id, (expires_at, size) = next(iter(self.index.items()))
+            if expires_at > now:
+                break
+            self._drop(user_id)
+            self.expirations += 1
+    
+    def stats(self) -> Dict[str, int]:
+        """Counters for sizing containers"""
+        return {
+            'sessions': len(self.index),
+            'bytes_held': self.bytes_held,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+    
+    def _drop(self, user_id: int):
+        session = self.backend.load(user_id)
+        self.bytes_held -= self.index.pop(user_id)[1]
+        self.backend.delete(user_id)
+        if session is not None:
+            discard_media(session.data)
+
+class VideoNormalizer:
+    """Bounded pool of ffmpeg subprocesses that shrink driving videos for animate mode
+
+    Clips are trimmed to the frames the job uses, resampled to a fixed fps,
+    downscaled to fit the target size, stripped of audio and re-encoded.
+    """
+    def __init__(self, workers: int, timeout: float, fps: int, maxrate: str):
+        self.slots = asyncio.Semaphore(workers)
+        self.timeout = timeout
+        self.fps = fps
+        self.maxrate = maxrate
+        self.available = bool(shutil.which('ffmpeg') and shutil.which('ffprobe'))
+        if not self.available:
+            logger.warning("ffmpeg/ffprobe not found; driving videos will be sent unmodified")
+    
+    async def _run(self, *args: str) -> tuple[int, bytes, bytes]:
+        """Run a subprocess, killing it if it exceeds the timeout"""
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        return process.returncode, stdout, stderr
+    
+    async def probe(self, path: str) -> Optional[Dict[str, Any]]:
+        """First video stream's properties, or None if the file has no video"""
+        code, stdout, _ = await self._run(
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,width,height,avg_frame_rate:format=duration',
+            '-of', 'json', path
+        )
+        if code != 0:
+            return None
+        info = json.loads(stdout or b'{}')
+        streams = info.get('streams') or []
+        if not streams:
+            return None
+        return {**streams[0], 'duration': info.get('format', {}).get('duration')}
+    
+    async def normalize(self, video: MediaFile, width: int, height: int, num_frames: int) -> MediaFile:
+        """Re-encode a driving video for the job. Raises ValueError if it has no video stream"""
+        if not self.available:
+            return video
+        
+        async with self.slots:
+            info = await self.probe(video.path)
+            if info is None:
+                raise ValueError("No video stream found")
+            
+            dst = os.path.splitext(video.path)[0] + '_normalized.mp4'
+            scale = (
+                f"scale=w='min({width},iw)':h='min({height},ih)'"
+                ":force_original_aspect_ratio=decrease:force_divisible_by=2"
+            )
+            size = None
+            try:
+                code, _, stderr = await self._run(
+                    'ffmpeg', '-nostdin', '-v', 'error', '-y',
+                    '-i', video.path,
+                    '-t', f"{num_frames / self.fps + 1:.3f}",
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-vf', f"fps={self.fps},{scale}",
+                    '-frames:v', str(num_frames),
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+                    '-maxrate', self.maxrate, '-bufsize', self.maxrate,
+                    '-pix_fmt', 'yuv420p', '-movflags', '+faststart',
+                    dst
+                )
+                if code != 0:
+                    raise RuntimeError(f"ffmpeg exited with {code}: {stderr.decode('utf-8', 'replace')[-300:]}")
+                size = os.path.getsize(dst)
+            finally:
+                # A timeout, failure or cancellation can leave a partial output behind
+                if size is None:
+                    remove_file(dst)
+        
+        logger.info(
+            f"Normalized driving video {info.get('width')}x{info.get('height')} "
+            f"{video.size} bytes -> {size} bytes"
+        )
+        video.discard()
+        # Keep the original's hash: normalization is deterministic, so cache keys stay stable
+        return MediaFile(dst, size, 'video/mp4', video.sha256)
+
+class ResultCache:
+    """Content-addressed cache of finished videos on local disk
+
+    Files are evicted least-recently-used once the cache exceeds max_bytes.
+    The Telegram media of the last upload is remembered per key so repeats
+    can be re-sent by file reference without uploading again.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.uploads = {}
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        
+        os.makedirs(directory, exist_ok=True)
+        # Rebuild LRU order from modification times, which lookups refresh
+        existing = []
+        for name in os.listdir(directory):
+            if name.endswith('.mp4'):
+                stat = os.stat(os.path.join(directory, name))
+                existing.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(existing):
+            self.entries[key] = size
+            self.bytes_held += size
+        self._evict()
+    
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp4")
+    
+    async def lookup(self, key: str) -> Optional[str]:
+        """Path of the cached video for key, or None on a miss"""
+        # Filesystem calls run in a thread: the cache may sit on slow or network storage
+        found = key in self.entries and await asyncio.to_thread(self._touch, self.path(key))
+        if not found or key not in self.entries:
+            if key in self.entries:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.path(key)
+    
+    async def store(self, key: str, video_path: str) -> str:
+        """Move a finished video into the cache. Returns its new path
+
+        Across filesystems the move is a full copy, so it runs in a thread.
+        """
+        target = self.path(key)
+        if key in self.entries:
+            self._remove(key)
+        size = await asyncio.to_thread(self._move, video_path, target)
+        # Another store for the same key may have finished while this one was moving
+        self.bytes_held += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        self._evict(keep=key)
+        return target
+    
+    @staticmethod
+    def _touch(path: str) -> bool:
+        """Refresh a file's LRU timestamp. Returns False if it is gone"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+    
+    @staticmethod
+    def _move(source: str, target: str) -> int:
+        shutil.move(source, target)
+        return os.path.getsize(target)
+    
+    def remember_upload(self, key: str, media):
+        """Remember the Telegram media of an upload for reuse"""
+        if key in self.entries and media is not None:
+            self.uploads[key] = media
+    
+    def forget_upload(self, key: str):
+        self.uploads.pop(key, None)
+    
+    def _evict(self, keep: Optional[str] = None):
+        while self.bytes_held > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            if oldest == keep:
+                break
+            self._remove(oldest)
+    
+    def _remove(self, key: str):
+        self.bytes_held -= self.entries.pop(key)
+        self.uploads.pop(key, None)
+        remove_file(self.path(key))
+
+class BackendUnavailable(Exception):
+    """Raised when no backend endpoint can take a submission"""
+
+class BatchRejected(Exception):
+    """Raised when the backend refuses a batch as a whole; its jobs should be sent one by one"""
+
+class BatchUnsupported(BatchRejected):
+    """Raised when the backend has no batch endpoint"""
+
+class BackendEndpoint:
+    """One backend base URL with its circuit breaker and latency statistics
+
+    The breaker opens after `failure_threshold` consecutive failures. Once
+    `open_seconds` have passed it lets a single trial request through
+    (half-open); success closes it and failure opens it again.
+    """
+    def __init__(self, base_url: str, failure_threshold: int, open_seconds: float):
+        self.base_url = base_url.rstrip('/')
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.outstanding = 0
+        self.ewma_latency = 1.0
+        self.requests = 0
+        self.errors = 0
+    
+    def available(self, now: float) -> bool:
+        """Check if the breaker lets a request through"""
+        if self.state == 'open' and now - self.opened_at >= self.open_seconds:
+            self.state = 'half_open'
+        if self.state == 'half_open':
+            return self.outstanding == 0
+        return self.state == 'closed'
+    
+    def score(self) -> float:
+        """Expected wait for a new request: latency scaled by requests already in flight"""
+        return (self.outstanding + 1) * self.ewma_latency
+    
+    def record_success(self, latency: Optional[float] = None):
+        if latency is not None:
+            self.ewma_latency += 0.3 * (latency - self.ewma_latency)
+        self.failures = 0
+        if self.state != 'closed':
+            logger.info(f"Backend {self.base_url} recovered")
+        self.state = 'closed'
+    
+    def record_failure(self, now: float):
+        self.failures += 1
+        self.errors += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            logger.warning(f"Backend {self.base_url} circuit opened after {self.failures} failure(s)")
+            self.state = 'open'
+            self.opened_at = now
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'url': self.base_url,
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'ewma_latency': round(self.ewma_latency, 3),
+            'requests': self.requests,
+            'errors': self.errors
+        }
+
+class BackendClient:
+    """Async client for the Modal generation backends with a shared connection pool
+
+    Submissions go to the available endpoint with the lowest expected wait.
+    Connection errors, timeouts, 429 and 5xx answers are retried on another
+    endpoint with jittered exponential backoff. Every attempt carries the
+    task id as an idempotency key, so a retry after a lost response is safe.
+    """
+    def __init__(self, base_urls: list[str], pool_size: int, endpoint_concurrency: int,
+                 connect_timeout: float, total_timeout: float, keepalive_timeout: float,
+                 failure_threshold: int, open_seconds: float, retries: int, retry_base: float,
+                 health_path: str, health_interval: float, status_path: str = '', batch_path: str = ''):
+        self.endpoints = [BackendEndpoint(url, failure_threshold, open_seconds) for url in base_urls]
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.probe_timeout = aiohttp.ClientTimeout(total=min(total_timeout, 5))
+        self.endpoint_limits = {mode: asyncio.Semaphore(endpoint_concurrency) for mode in ENDPOINT_PATHS}
+        self.retries = retries
+        self.retry_base = retry_base
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.status_path = status_path
+        self.batch_path = batch_path
+        self.accepted_by = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, creating it on first use inside the running loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    def pick_endpoint(self, exclude: set) -> Optional[BackendEndpoint]:
+        """Available endpoint with the lowest score, preferring ones not tried yet"""
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+        fresh = [endpoint for endpoint in candidates if endpoint.base_url not in exclude]
+        return min(fresh or candidates, key=BackendEndpoint.score, default=None)
+    
+    async def submit(self, mode: str, payload: Dict[str, Any]) -> tuple[int, str]:
+        """Submit a generation job. Returns (status_code, response_text)"""
+        path = ENDPOINT_PATHS.get(mode)
+        if not path:
+            raise ValueError(f"Unknown generation mode: {mode}")
+        
+        body = JsonMediaPayload(payload)
+        status, text, endpoint = await self._post(mode, path, body, str(payload.get('task_id', '')))
+        if status < 300 and payload.get('task_id'):
+            self.accepted_by[payload['task_id']] = endpoint
+        return status, text
+    
+    async def submit_batch(self, mode: str, payloads: list[Dict[str, Any]]) -> list[tuple[int, str]]:
+        """Submit several jobs in one request. Returns (status_code, response_text) per job, in order
+
+        The batch endpoint answers {"results": [{"task_id", "status_code", ...}]}.
+        Each job carries its own task_id and webhook_url, so results come back
+        through the usual per-task webhooks.
+        """
+        if not self.batch_path:
+            raise BatchUnsupported("No batch endpoint configured")
+        
+        task_ids = [str(payload.get('task_id', '')) for payload in payloads]
+        key = 'batch-' + hashlib.sha256(','.join(task_ids).encode('utf-8')).hexdigest()[:32]
+        # The request carries every job's media, so it gets every job's time budget
+        timeout = aiohttp.ClientTimeout(total=self.timeout.total * len(payloads), connect=self.timeout.connect)
+        status, text, endpoint = await self._post(mode, self.batch_path, JsonBatchPayload(mode, payloads), key, timeout)
+        if status in (404, 405):
+            raise BatchUnsupported(f"Batch endpoint returned {status}")
+        if 400 <= status < 500 and status != 429:
+            # One invalid or oversized job must not fail the others
+            raise BatchRejected(f"Batch endpoint returned {status}: {text[:200]}")
+        if status != 200:
+            return [(status, text)] * len(payloads)
+        
+        try:
+            results = {str(result['task_id']): result for result in json.loads(text)['results']}
+        except (ValueError, KeyError, TypeError):
+            return [(502, f"Unreadable batch response: {text[:200]}")] * len(payloads)
+        outcomes = []
+        for task_id in task_ids:
+            result = results.get(task_id)
+            if result is None:
+                outcomes.append((502, "Task missing from batch response"))
+                continue
+            status = int(result.get('status_code', 200))
+            if status < 300:
+                self.accepted_by[task_id] = endpoint
+            outcomes.append((status, json.dumps(result)))
+        return outcomes
+    
+    async def _post(self, mode: str, path: str, body, idempotency_key: str,
+                    timeout: Optional[aiohttp.ClientTimeout] = None) -> tuple[int, str, BackendEndpoint]:
+        """POST a streamed body to the best endpoint, retrying transient failures elsewhere"""
+        headers = {
+            'Content-Type': 'application/json',
+            'Content-Length': str(body.content_length),
+            'Idempotency-Key': idempotency_key
+        }
+        
+        tried = set()
+        async with self.endpoint_limits[mode]:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(random.uniform(0, self.retry_base * 2 ** attempt))
+                endpoint = self.pick_endpoint(tried)
+                if endpoint is None:
+                    raise BackendUnavailable("All backend endpoints are unavailable")
+                tried.add(endpoint.base_url)
+                
+                endpoint.outstanding += 1
+                endpoint.requests += 1
+                started = time.monotonic()
+                try:
+                    async with self._get_session().post(
+                        f"{endpoint.base_url}{path}", data=body.chunks(), headers=headers, timeout=timeout or self.timeout
+                    ) as response:
+                        status, text = response.status, await response.text()
+                    BACKEND_SUBMIT_TOTAL.inc(endpoint.base_url, str(status))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    BACKEND_SUBMIT_TOTAL.inc(endpoint.base_url, 'error')
+                    endpoint.record_failure(time.monotonic())
+                    logger.warning(f"Submit to {endpoint.base_url} failed (attempt {attempt + 1}): {e!r}")
+                    if attempt == self.retries:
+                        raise
+                    continue
+                finally:
+                    endpoint.outstanding -= 1
+                    BACKEND_SUBMIT_LATENCY.observe(time.monotonic() - started, endpoint.base_url)
+                
+                if status == 429 or status >= 500:
+                    endpoint.record_failure(time.monotonic())
+                    logger.warning(f"Submit to {endpoint.base_url} returned {status} (attempt {attempt + 1})")
+                    if attempt < self.retries:
+                        continue
+                else:
+                    endpoint.record_success(time.monotonic() - started)
+                return status, text, endpoint
+    
+    async def status(self, task_id: str) -> Optional[str]:
+        """Ask the endpoint that accepted a task for its status; None if unknown or polling is off"""
+        if not self.status_path:
+            return None
+        endpoint = self.accepted_by.get(task_id) or self.pick_endpoint(set())
+        if endpoint is None:
+            return None
+        try:
+            async with self._get_session().get(
+                f"{endpoint.base_url}{self.status_path.format(task_id=task_id)}", timeout=self.probe_timeout
+            ) as response:
+                if response.status != 200:
+                    return None
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+        status = data.get('status') if isinstance(data, dict) else None
+        return str(status).lower() if status else None
+    
+    def forget(self, task_id: str):
+        self.accepted_by.pop(task_id, None)
+    
+    async def probe(self, endpoint: BackendEndpoint):
+        """Check one endpoint; any answer below 500 counts as reachable"""
+        try:
+            async with self._get_session().get(
+                f"{endpoint.base_url}{self.health_path}", timeout=self.probe_timeout
+            ) as response:
+                healthy = response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        if healthy:
+            endpoint.record_success()
+        elif endpoint.state != 'open':
+            endpoint.record_failure(time.monotonic())
+    
+    async def probe_loop(self):
+        """Periodically probe all endpoints so dead ones are skipped and recovered ones rejoin"""
+        while True:
+            await asyncio.gather(*(self.probe(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.health_interval)
+    
+    def stats(self) -> list[Dict[str, Any]]:
+        return [endpoint.stats() for endpoint in self.endpoints]
+    
+    async def close(self):
+        """Close the shared session and its pooled connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+class SubmissionBatcher:
+    """Groups compatible submissions into one request to the backend's batch endpoint
+
+    Jobs with the same mode, width, height and num_frames that arrive within
+    `window` seconds of the first share a request, up to `max_size` jobs. A
+    lone job uses the plain endpoint, a batch refused as a whole is resent job
+    by job, and if the backend turns out to have no batch endpoint every job
+    uses the plain one from then on. Callers see the same
+    (status_code, response_text) as BackendClient.submit.
+    """
+    def __init__(self, backend: BackendClient, window: float, max_size: int):
+        self.backend = backend
+        self.window = window
+        self.max_size = max_size
+        self.supported = True
+        self.groups = {}
+        self.sending = set()
+    
+    async def submit(self, mode: str, payload: Dict[str, Any]) -> tuple[int, str]:
+        if not self.supported or self.max_size < 2:
+            return await self.backend.submit(mode, payload)
+        
+        key = (mode, payload.get('width'), payload.get('height'), payload.get('num_frames'))
+        future = asyncio.get_running_loop().create_future()
+        group = self.groups.get(key)
+        if group is None:
+            timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+            group = self.groups[key] = (timer, [])
+        group[1].append((payload, future))
+        if len(group[1]) >= self.max_size:
+            self._flush(key)
+        return await future
+    
+    def _flush(self, key: tuple):
+        group = self.groups.pop(key, None)
+        if group is None:
+            return
+        timer, entries = group
+        timer.cancel()
+        task = asyncio.create_task(self._send(key[0], entries))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+    
+    async def _settle(self, future: asyncio.Future, submission):
+        try:
+            result = await submission
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+    
+    async def _send(self, mode: str, entries: list[tuple[Dict[str, Any], asyncio.Future]]):
+        BATCH_SIZE.observe(len(entries))
+        try:
+            if len(entries) == 1:
+                payload, future = entries[0]
+                await self._settle(future, self.backend.submit(mode, payload))
+                return
+            
+            try:
+                results = await self.backend.submit_batch(mode, [payload for payload, future in entries])
+            except BatchRejected as e:
+                if isinstance(e, BatchUnsupported):
+                    self.supported = False
+                logger.warning(f"Batch submission refused, submitting {len(entries)} job(s) one by one: {e}")
+                await asyncio.gather(*(self._settle(future, self.backend.submit(mode, payload)) for payload, future in entries))
+                return
+            except Exception as e:
+                for payload, future in entries:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (payload, future), result in zip(entries, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            # Cancelled mid-send (e.g. at shutdown): callers must not wait forever
+            for payload, future in entries:
+                if not future.done():
+                    future.cancel()
+    
+    async def close(self):
+        """Cancel pending groups and in-flight sends"""
+        for timer, entries in self.groups.values():
+            timer.cancel()
+            for payload, future in entries:
+                future.cancel()
+        self.groups.clear()
+        for task in list(self.sending):
+            task.cancel()
+        await asyncio.gather(*self.sending, return_exceptions=True)
+
+class OutboundJob:
+    __slots__ = ('chat_id', 'factory', 'priority', 'upload', 'retries', 'future')
+    
+    def __init__(self, chat_id: int, factory, priority: int, upload: bool, retries: int, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.priority = priority
+        self.upload = upload
+        self.retries = retries
+        self.future = future
+
+class OutboundScheduler:
+    """Paces every user-facing Telegram call through global and per-chat token buckets
+
+    Calls wait in priority lanes; a single dispatcher starts the first call
+    of the highest lane whose chat has a token, so one busy chat never blocks
+    the others. A FloodWait pauses all sends for the time Telegram asks and
+    the call is retried at the front of its lane. Uploads are also bounded
+    by a semaphore so large files cannot take every connection.
+    """
+    SCAN_LIMIT = 64
+    
+    def __init__(self, global_rate: float, global_burst: int, chat_rate: float, chat_burst: int,
+                 upload_concurrency: int, max_retries: int):
+        self.lanes = [deque() for _ in (PRIORITY_RESULT, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)]
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.uploads = asyncio.Semaphore(upload_concurrency)
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.wakeup = asyncio.Event()
+        self.running = set()
+        self.last_prune = time.monotonic()
+    
+    async def submit(self, chat_id: int, factory, priority: int = PRIORITY_INTERACTIVE, upload: bool = False,
+                     retries: Optional[int] = None):
+        """Run factory() once the chat may be sent to; returns its result"""
+        future = asyncio.get_running_loop().create_future()
+        retries = self.max_retries if retries is None else retries
+        self.lanes[priority].append(OutboundJob(chat_id, factory, priority, upload, retries, future))
+        self.wakeup.set()
+        return await future
+    
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            delay = self._dispatch()
+            for priority, lane in enumerate(self.lanes):
+                OUTBOUND_QUEUED.set(len(lane), str(priority))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _dispatch(self) -> Optional[float]:
+        """Start every call that may go now; returns seconds until the next one may, or None if idle"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._prune(now)
+        
+        next_delay = None
+        for lane in self.lanes:
+            index = 0
+            while index < len(lane) and index < self.SCAN_LIMIT:
+                job = lane[index]
+                if job.future.done():
+                    del lane[index]
+                    continue
+                global_delay = self.global_bucket.wait_time(now)
+                if global_delay:
+                    return global_delay
+                bucket = self.chat_buckets.get(job.chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[job.chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                chat_delay = bucket.wait_time(now)
+                if chat_delay:
+                    next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+                    index += 1
+                    continue
+                del lane[index]
+                self.global_bucket.take()
+                bucket.take()
+                task = asyncio.create_task(self._execute(job))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            if len(lane) > index:
+                next_delay = 0.05 if next_delay is None else min(next_delay, 0.05)
+        return next_delay
+    
+    def _prune(self, now: float):
+        """Drop buckets of chats that are idle and full again"""
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if bucket.wait_time(now) == 0 and bucket.idle()]:
+            del self.chat_buckets[chat_id]
+    
+    async def _execute(self, job: OutboundJob):
+        if job.future.done():
+            return
+        try:
+            if job.upload:
+                async with self.uploads:
+                    result = await job.factory()
+            else:
+                result = await job.factory()
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+            raise
+        except errors.FloodWaitError as e:
+            FLOOD_WAITS.inc()
+            logger.warning(f"FloodWait of {e.seconds}s from Telegram, pausing outbound sends")
+            self.paused_until = max(self.paused_until, time.monotonic() + e.seconds)
+            if job.retries > 0 and not job.future.done():
+                job.retries -= 1
+                self.lanes[job.priority].appendleft(job)
+                self.wakeup.set()
+            elif not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
     
-    def add_request(self, user_id: int):
-        """Record a new request"""
-        self.requests[user_id].append(datetime.now())
+    async def close(self):
+        """Fail queued calls and cancel running ones, so no caller waits on a stopped scheduler"""
+        for lane in self.lanes:
+            while lane:
+                job = lane.popleft()
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("Outbound scheduler stopped"))
+        for task in list(self.running):
+            task.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+
+def progress_text(data: Dict[str, Any]) -> str:
+    """Render a progress webhook as the text of the task's status message"""
+    status = data.get('status')
+    step, steps = data.get('step'), data.get('steps')
+    if status == 'queued':
+        position = data.get('position')
+        line = f"🕒 Waiting for a GPU{f' (position {position})' if position else ''}..."
+    elif status == 'encoding':
+        line = "🎞 Encoding video..."
+        step, steps = 1, 1
+    elif isinstance(step, int) and isinstance(steps, int) and steps > 0:
+        line = f"🎨 Rendering: step {min(step, steps)}/{steps}"
+    else:
+        line = "🎨 Rendering..."
     
-    def get_remaining_requests(self, user_id: int) -> int:
-        """Get remaining requests for user"""
-        now = datetime.now()
-        user_requests = self.requests[user_id]
-        
-        # Remove old requests
-        while user_requests and (now - user_requests[0]).total_seconds() > self.window_seconds:
-            user_requests.popleft()
-        
-        return self.max_requests - len(user_requests)
+    text = "⚙️ **Generating your video...**\n\n" + line
+    if isinstance(step, int) and isinstance(steps, int) and steps > 0:
+        filled = round(10 * min(step, steps) / steps)
+        text += f"\n{'▰' * filled}{'▱' * (10 - filled)} {100 * min(step, steps) // steps}%"
+    return text
 
-class TaskQueue:
-    """Queue manager for video generation tasks"""
-    def __init__(self, max_global: int, max_per_user: int):
-        self.max_global = max_global
-        self.max_per_user = max_per_user
-        self.global_queue = []
-        self.user_tasks = defaultdict(int)
-        self.lock = threading.Lock()
+class ProgressEditor:
+    """Coalesces progress edits of task status messages within Telegram's flood limits
+
+    Only the newest text per task is kept. A single worker edits at most
+    edits_per_second messages across all chats and touches each chat at most
+    once per chat_interval; a FloodWait pauses all edits for the requested time.
+    """
+    def __init__(self, outbound: OutboundScheduler, chat_interval: float, edits_per_second: float, tick: float):
+        self.outbound = outbound
+        self.chat_interval = chat_interval
+        self.edits_per_tick = max(1, int(edits_per_second * tick))
+        self.tick = tick
+        self.messages = {}
+        self.pending = OrderedDict()
+        self.last_text = {}
+        self.last_edit = {}
+        self.paused_until = 0.0
     
-    def can_add_task(self, user_id: int) -> tuple[bool, Optional[str]]:
-        """Check if task can be added. Returns (allowed, reason)"""
-        with self.lock:
-            if len(self.global_queue) >= self.max_global:
-                return False, f"Server queue is full ({self.max_global} tasks). Please try again later."
-            
-            if self.user_tasks[user_id] >= self.max_per_user:
-                return False, f"You have {self.max_per_user} task(s) in progress. Please wait for completion."
-            
-            return True, None
+    def track(self, task_id: str, message):
+        """Remember the status message that progress for this task should edit"""
+        self.messages[task_id] = message
     
-    def add_task(self, task_id: str, user_id: int):
-        """Add task to queue"""
-        with self.lock:
-            self.global_queue.append(task_id)
-            self.user_tasks[user_id] += 1
+    def update(self, task_id: str, text: str) -> bool:
+        """Queue new text for a task's message, replacing any edit not yet sent"""
+        if task_id not in self.messages:
+            return False
+        if self.last_text.get(task_id) != text:
+            self.pending[task_id] = text
+        return True
     
-    def remove_task(self, task_id: str, user_id: int):
-        """Remove task from queue"""
-        with self.lock:
-            if task_id in self.global_queue:
-                self.global_queue.remove(task_id)
-            if self.user_tasks[user_id] > 0:
-                self.user_tasks[user_id] -= 1
+    def forget(self, task_id: str):
+        message = self.messages.pop(task_id, None)
+        self.pending.pop(task_id, None)
+        self.last_text.pop(task_id, None)
+        if message is not None:
+            self.last_edit.pop(message.chat_id, None)
     
-    def get_queue_info(self, user_id: int) -> Dict[str, int]:
-        """Get queue information"""
-        with self.lock:
-            return {
-                'global_queue': len(self.global_queue),
-                'max_global': self.max_global,
-                'user_tasks': self.user_tasks[user_id],
-                'max_per_user': self.max_per_user
-            }
+    async def _edit(self, task_id: str, message, text: str):
+        try:
+            # Progress is never retried by the scheduler; a newer update replaces it instead
+            await self.outbound.submit(message.chat_id, lambda: message.edit(text), PRIORITY_BACKGROUND, retries=0)
+            self.last_text[task_id] = text
+        except errors.FloodWaitError as e:
+            logger.warning(f"FloodWait on progress edits, pausing {e.seconds}s")
+            self.paused_until = time.monotonic() + e.seconds
+            if task_id in self.messages:
+                self.pending.setdefault(task_id, text)
+        except errors.MessageNotModifiedError:
+            self.last_text[task_id] = text
+        except Exception as e:
+            logger.debug(f"Progress edit for task {task_id} failed: {e}")
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            if now < self.paused_until or not self.pending:
+                continue
+            
+            # One batch per tick, oldest updates first, skipping chats edited too recently
+            batch = []
+            for task_id, text in self.pending.items():
+                message = self.messages[task_id]
+                if now - self.last_edit.get(message.chat_id, 0.0) < self.chat_interval:
+                    continue
+                self.last_edit[message.chat_id] = now
+                batch.append((task_id, message, text))
+                if len(batch) >= self.edits_per_tick:
+                    break
+            for task_id, _, _ in batch:
+                del self.pending[task_id]
+            if batch:
+                await asyncio.gather(*(self._edit(*entry) for entry in batch))
 
 class WanVideoBot:
-    def __init__(self):
-        self.client = TelegramClient('bot_session', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
-        self.user_states = {}
-        self.user_data = {}
-        self.task_to_user = {}
+    def __init__(self, client=None):
+        # A client can be injected, e.g. the benchmark's fake Telegram client
+        self.client = client or TelegramClient('bot_session', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+        if SESSION_BACKEND == 'disk':
+            session_backend = DiskSessionBackend(SESSION_DIR)
+        else:
+            session_backend = MemorySessionBackend()
+        self.sessions = SessionStore(session_backend, SESSION_TTL, SESSION_MEMORY_BUDGET)
+        self.outbound = OutboundScheduler(
+            SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_UPLOAD_CONCURRENCY, SEND_MAX_RETRIES
+        )
         self.WEBHOOK_URL = os.getenv('KINSTA_PUBLIC_URL', 'https://tes-brq7a.sevalla.app/').rstrip('/') + '/webhook'
         
-        # Rate limiting and queue management
-        self.rate_limiter = RateLimiter(MAX_REQUESTS_PER_HOUR, RATE_LIMIT_WINDOW)
-        self.task_queue = TaskQueue(MAX_GLOBAL_QUEUE, CONCURRENT_TASKS_PER_USER)
+        # Uploaded media and finished videos are spooled here; files left by a previous run are orphaned
+        for spool_dir in (MEDIA_TMP_DIR, RESULT_TMP_DIR):
+            shutil.rmtree(spool_dir, ignore_errors=True)
+            os.makedirs(spool_dir, exist_ok=True)
+        
+        # Rate limits, slots and the task map, shared between replicas when a coordination database is set
+        if COORDINATION_BACKEND == 'sqlite':
+            # Rows outlive the slowest task twice over, including its time held in the queue, before they are orphans
+            stale_after = COORDINATION_STALE_AFTER or 2 * (
+                max(task_timeout(wizard.defaults) for wizard in WIZARDS.values())
+                + TASK_MAX_EXTENSIONS * TASK_TIMEOUT_EXTENSION
+                + MAX_WAITING_QUEUE / max(MAX_GLOBAL_QUEUE, 1) * TASK_DURATION_ESTIMATE
+            )
+            self.coordinator = SQLiteCoordinator(
+                COORDINATION_DB_PATH, USER_GPU_BUDGET, RATE_LIMIT_WINDOW, GLOBAL_GPU_RATE, GLOBAL_GPU_BURST, stale_after
+            )
+        else:
+            self.coordinator = MemoryCoordinator(
+                RateLimiter(USER_GPU_BUDGET, RATE_LIMIT_WINDOW), TokenBucket(GLOBAL_GPU_RATE, GLOBAL_GPU_BURST)
+            )
+        self.tiers = {
+            'admin': Tier('admin', TIER_ADMIN_WEIGHT, TIER_ADMIN_TASKS, TIER_ADMIN_HELD_SHARE),
+            'premium': Tier('premium', TIER_PREMIUM_WEIGHT, TIER_PREMIUM_TASKS, TIER_PREMIUM_HELD_SHARE),
+            'free': Tier('free', TIER_FREE_WEIGHT, TIER_FREE_TASKS, TIER_FREE_HELD_SHARE)
+        }
+        self.task_queue = TaskQueue(MAX_GLOBAL_QUEUE, MAX_WAITING_QUEUE, TASK_DURATION_ESTIMATE)
+        self.held_tasks = {}
+        self.cost_model = CostModel(COST_SECONDS_PER_UNIT, COST_OVERHEAD, COST_LEARNING_RATE)
+        self.task_work = {}
+        self.dispatch_lock = asyncio.Lock()
+        self.intake_paused = False
+        self.throughput = ThroughputTracker()
+        self.deadlines = TaskDeadlines()
+        self.progress = ProgressEditor(self.outbound, PROGRESS_CHAT_INTERVAL, PROGRESS_EDITS_PER_SECOND, PROGRESS_TICK)
+        self.result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+        self.image_pool = ThreadPoolExecutor(IMAGE_PREPROCESS_WORKERS, thread_name_prefix='image-preprocess')
+        self.video_normalizer = VideoNormalizer(FFMPEG_WORKERS, FFMPEG_TIMEOUT, ANIMATE_VIDEO_FPS, ANIMATE_VIDEO_MAXRATE)
+        self.background_tasks = set()
+        self.workers = []
+        
+        # Durable task registry; jobs still running on the backend are reloaded once everything is built
+        self.task_store = TaskStore(TASK_DB_PATH, TASK_DB_FLUSH_INTERVAL, TASK_DB_RETENTION)
+        
+        # Pooled async client for the generation backend
+        self.backend = BackendClient(
+            MODAL_API_URLS,
+            pool_size=BACKEND_POOL_SIZE,
+            endpoint_concurrency=BACKEND_ENDPOINT_CONCURRENCY,
+            connect_timeout=BACKEND_CONNECT_TIMEOUT,
+            total_timeout=BACKEND_TOTAL_TIMEOUT,
+            keepalive_timeout=BACKEND_KEEPALIVE_TIMEOUT,
+            failure_threshold=BACKEND_FAILURE_THRESHOLD,
+            open_seconds=BACKEND_OPEN_SECONDS,
+            retries=BACKEND_RETRIES,
+            retry_base=BACKEND_RETRY_BASE,
+            health_path=BACKEND_HEALTH_PATH,
+            health_interval=BACKEND_HEALTH_INTERVAL,
+            status_path=BACKEND_STATUS_PATH,
+            batch_path=BACKEND_BATCH_PATH
+        )
+        
+        # Compatible submissions share one backend request when a batch endpoint is configured
+        self.submitter = (SubmissionBatcher(self.backend, BATCH_WINDOW, BATCH_MAX_SIZE)
+                          if BACKEND_BATCH_PATH else self.backend)
+        
+        # Webhook server, started on the client's loop in run()
+        self.webhook_server = WebhookServer(
+            self,
+            port=WEBHOOK_PORT,
+            max_body=WEBHOOK_MAX_BODY,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+            acquire_timeout=WEBHOOK_ACQUIRE_TIMEOUT
+        )
+        
+        # Stall detection and on-demand profiling of the event loop
+        self.watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD, LOOP_STALL_HISTORY, PROFILER_SAMPLE_INTERVAL)
+        self.watchdog.register(self.webhook_server.handle_webhook, self.webhook_server.health_check,
+                               self.webhook_server.metrics)
         
         self.camera_motions = [
             "ZoomIn", "ZoomOut", "PanLeft", "PanRight", 
             "TiltUp", "TiltDown", "RollingClockwise", "RollingAnticlockwise"
         ]
         
+        # Dispatch tables: raw callback data, command word and wizard step map straight to a handler
+        self.callback_routes = {
+            b'main_menu': (Callback.MAIN_MENU, self.show_main_menu, ()),
+            b't2v': (Callback.T2V, self.start_mode, ('t2v',)),
+            b'i2v': (Callback.I2V, self.start_mode, ('i2v',)),
+            b'animate': (Callback.ANIMATE, self.start_mode, ('animate',)),
+            b'camera': (Callback.CAMERA, self.start_camera_selection, ()),
+            b'help': (Callback.HELP, self.show_help, ()),
+            b'cancel': (Callback.CANCEL, self.cancel_operation, ()),
+            b'generate': (Callback.GENERATE, self.generate_video, ())
+        }
+        for motion in self.camera_motions:
+            self.callback_routes[f"camera_{motion}".encode('utf-8')] = (
+                Callback.CAMERA_MOTION, self.select_camera_motion, (motion,)
+            )
+        self.command_routes = {
+            '/start': (self.show_main_menu_message, None),
+            '/help': (self.show_help_message, None),
+            '/skip': (self.handle_skip, None),
+            '/stats': (self.show_stats, None),
+            '/profile': (self.handle_profile, re.compile(r'/profile(?:@\w+)?(?:\s+(\w+))?(?:\s+(\d+))?$')),
+            '/stalls': (self.show_stalls, None),
+            '/admin': (self.handle_admin, re.compile(r'/admin(?:@\w+)?(?:\s+(.*))?$'))
+        }
+        self.step_handlers = {
+            Step.IMAGE: self.handle_image,
+            Step.REFERENCE: self.handle_image,
+            Step.VIDEO: self.handle_video,
+            Step.PROMPT: self.handle_prompt,
+            Step.NEGATIVE: self.handle_negative_prompt
+        }
+        
+        self.client.loop.run_until_complete(self.restore_tasks())
         self.setup_handlers()
     
-    def setup_handlers(self):
-        """Setup all event handlers"""
-        
-        @self.client.on(events.NewMessage(pattern='/start'))
-        async def start_handler(event):
-            await self.show_main_menu_message(event)
+    async def restore_tasks(self):
+        """Rebuild slots, task map and rate-limit counters from the task store"""
+        pending = self.task_store.load_pending()
+        lost = []
+        for task_id, user_id, chat_id, mode, submitted_at, status, leader_id, cost in pending:
+            if status == 'queued':
+                # Held tasks never reached the backend and their media did not survive the restart
+                if self.coordinator.shared:
+                    await self.fail_submission(task_id, user_id, refund=True)
+                else:
+                    lost.append(task_id)
+                self.spawn(self.send_message(
+                    chat_id,
+                    "⚠️ Your queued task was lost during a server restart. Please submit it again.\n"
+                    "It did not count against your hourly limit.",
+                    priority=PRIORITY_BACKGROUND
+                ))
+                continue
+            if leader_id is None:
+                # The job parameters are not stored, so restored tasks get the default timeout
+                remaining = submitted_at + task_timeout({}) - time.time()
+                self.deadlines.schedule(task_id, time.monotonic() + max(remaining, REAPER_INTERVAL))
+            if self.coordinator.shared:
+                # Slots and the task map live in the shared database and survived the restart
+                continue
+            task = TaskRef(task_id, user_id, chat_id, leader_id=leader_id, submitted_at=submitted_at, cost=cost)
+            if not await self.coordinator.register_task(task):
+                self.task_store.update_status(task_id, 'failed')
+                continue
+            await self.coordinator.acquire_user_slot(user_id, math.inf)
+            if leader_id is None:
+                await self.coordinator.acquire_backend_slot(task_id, math.inf)
+                self.task_queue.mark_started(task_id)
         
-        @self.client.on(events.NewMessage(pattern='/help'))
-        async def help_handler(event):
-            await self.show_help_message(event)
+        # Written synchronously, so the replay below does not charge the lost tasks again
+        self.task_store.fail_unsent(lost)
+        recent = []
+        if not self.coordinator.shared:
+            recent = self.task_store.load_requests_since(time.time() - RATE_LIMIT_WINDOW)
+            for user_id, submitted_at, cost in recent:
+                self.coordinator.restore_request(user_id, submitted_at, cost)
         
-        @self.client.on(events.NewMessage(pattern='/skip'))
-        async def skip_handler(event):
-            await self.handle_skip(event)
+        if pending or recent:
+            logger.info(f"Restored {len(pending)} pending task(s) and {len(recent)} recent request(s)")
+    
+    def setup_handlers(self):
+        """Register one handler per update type; routing happens in the dispatch tables"""
         
-        @self.client.on(events.NewMessage(pattern='/stats'))
-        async def stats_handler(event):
-            await self.show_stats(event)
+        @self.client.on(events.NewMessage())
+        async def message_handler(event):
+            await self.dispatch_message(event)
         
         @self.client.on(events.CallbackQuery())
         async def callback_handler(event):
             await self.handle_callback(event)
         
-        @self.client.on(events.NewMessage(func=lambda e: not e.text.startswith('/')))
-        async def message_handler(event):
+        # The dispatchers wrap everything, so stalls are attributed to the routed handler instead
+        self.watchdog.register(
+            *(route[1] for route in self.callback_routes.values()),
+            *(route[0] for route in self.command_routes.values()),
+            *self.step_handlers.values()
+        )
+    
+    async def dispatch_message(self, event):
+        """Route a command by its first word, anything else to the user's wizard step"""
+        text = event.text or ''
+        if not text.startswith('/'):
             await self.handle_message(event)
+            return
+        
+        route = self.command_routes.get(text.split(None, 1)[0].partition('@')[0])
+        if route is None:
+            return
+        handler, pattern = route
+        if pattern is not None:
+            event.pattern_match = pattern.match(text)
+            if event.pattern_match is None:
+                return
+        await handler(event)
     
     async def handle_callback(self, event):
         """Handle callback queries"""
-        user_id = event.sender_id
-        data = event.data.decode('utf-8')
+        route = self.callback_routes.get(event.data)
+        if route is None:
+            HANDLER_LATENCY.observe(0.0, 'other')
+            return
         
+        action, handler, args = route
+        started = time.perf_counter()
         try:
-            if data == "main_menu":
-                await self.show_main_menu(event)
-            elif data == "t2v":
-                await self.start_mode(event, 't2v')
-            elif data == "i2v":
-                await self.start_mode(event, 'i2v')
-            elif data == "animate":
-                await self.start_mode(event, 'animate')
-            elif data == "camera":
-                await self.start_camera_selection(event)
-            elif data == "help":
-                await self.show_help(event)
-            elif data.startswith("camera_"):
-                motion = data.replace("camera_", "")
-                await self.select_camera_motion(event, motion)
-            elif data == "cancel":
-                await self.cancel_operation(event)
-            elif data == "generate":
-                await self.generate_video(event)
+            await handler(event, *args)
         except Exception as e:
             logger.error(f"Callback error: {e}", exc_info=True)
             try:
                 await event.answer("❌ Error occurred", alert=True)
             except:
                 pass
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, action.value)
     
     async def handle_message(self, event):
-        """Handle text and media messages"""
-        user_id = event.sender_id
-        
-        if user_id not in self.user_states:
+        """Handle text and media messages for the user's current wizard step"""
+        session = self.sessions.get(event.sender_id)
+        if session is None:
+            return
+        handler = self.step_handlers.get(session.step)
+        if handler is None:
             return
         
-        state = self.user_states[user_id]
-        
+        started = time.perf_counter()
         try:
-            # Text handlers
-            if state.endswith('_prompt'):
-                await self.handle_prompt(event, state.replace('_prompt', ''))
-            elif state.endswith('_negative'):
-                await self.handle_negative_prompt(event, state.replace('_negative', ''))
-            # Media handlers
-            elif state.endswith('_image'):
-                if event.media:
-                    await self.handle_image(event, state.replace('_image', ''))
-                else:
-                    await event.respond("📷 Please send an image!")
-            elif state == 'animate_video':
-                if event.media:
-                    await self.handle_video(event)
-                else:
-                    await event.respond("🎬 Please send a video!")
+            reminder = MEDIA_STEPS.get(session.step)
+            if reminder is not None and not event.media:
+                await self.respond(event, reminder)
+            else:
+                await handler(event, session)
         except Exception as e:
             logger.error(f"Message handler error: {e}", exc_info=True)
-            await event.respond("❌ An error occurred. Please try /start again.")
+            await self.respond(event, "❌ An error occurred. Please try /start again.")
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, 'message')
+    
+    async def download_to_disk(self, event, user_id: int) -> MediaFile:
+        """Stream the message's media to a temp file"""
+        ext = (event.file.ext if event.file else None) or ''
+        target = os.path.join(MEDIA_TMP_DIR, f"{user_id}_{uuid.uuid4().hex}{ext}")
+        mime_type = event.file.mime_type if event.file else None
+        kind = mime_type.split('/')[0] if mime_type else 'other'
+        started = time.perf_counter()
+        path = await event.download_media(file=target)
+        size = os.path.getsize(path)
+        MEDIA_DOWNLOAD_LATENCY.observe(time.perf_counter() - started, kind)
+        MEDIA_DOWNLOAD_BYTES.inc(kind, amount=size)
+        digest = await asyncio.to_thread(file_sha256, path)
+        return MediaFile(path, size, mime_type, digest)
+    
+    def exceeds_size_limit(self, event) -> bool:
+        """Check the declared media size before downloading anything"""
+        return bool(event.file and event.file.size and event.file.size > MAX_FILE_SIZE)
+    
+    async def prepare_image(self, image: MediaFile, width: int, height: int) -> MediaFile:
+        """Shrink an uploaded image to the mode's target size off the event loop"""
+        dst_base = os.path.splitext(image.path)[0] + '_prepared'
+        try:
+            path, mime_type = await self.client.loop.run_in_executor(
+                self.image_pool, preprocess_image, image.path, dst_base, width, height, IMAGE_QUALITY
+            )
+        except Exception:
+            for ext in ('.jpg', '.webp'):
+                remove_file(dst_base + ext)
+            raise
+        image.discard()
+        # Keep the original's hash: preprocessing is deterministic, so cache keys stay stable
+        return MediaFile(path, os.path.getsize(path), mime_type, image.sha256)
+    
+    async def attach_media(self, event, key: str, media: MediaFile, mode: str, step: Step) -> bool:
+        """Store downloaded media in the user's session and advance the wizard
+
+        mode and step are where the wizard was when the upload arrived; if the
+        user has moved on since, the media no longer belongs anywhere.
+        """
+        user_id = event.sender_id
+        session = self.sessions.get(user_id)
+        if session is None:
+            # The session expired or was evicted while the file was downloading
+            media.discard()
+            await self.respond(event, "⌛ Your session expired. Please /start again.")
+            return False
+        if not session.at(mode, step):
+            media.discard()
+            await self.respond(event, "⚠️ This file arrived after you left that step, so it was not used.")
+            return False
+        
+        previous = session.data.get(key)
+        if isinstance(previous, MediaFile):
+            previous.discard()
+        session.data[key] = media
+        session.advance()
+        self.sessions.save(user_id, session)
+        return True
     
     async def show_main_menu_message(self, event):
         """Show main menu as new message"""
         user_id = event.sender_id
-        self.user_states[user_id] = 'main_menu'
+        self.sessions.set_state(user_id, None, Step.MENU)
         
-        await event.respond(
+        await self.respond(
+            event,
             f"🎬 **Welcome to {BOT_USERNAME}!**\n\n"
             "I can generate videos from text, images, or apply camera motions.\n\n"
             "Choose an option below:",
@@ -247,9 +2869,10 @@ class WanVideoBot:
     async def show_main_menu(self, event):
         """Show main menu by editing message"""
         user_id = event.sender_id
-        self.user_states[user_id] = 'main_menu'
+        self.sessions.set_state(user_id, None, Step.MENU)
         
-        await event.edit(
+        await self.edit(
+            event,
             f"🎬 **{BOT_USERNAME} Main Menu**\n\n"
             "Choose what you want to create:",
             buttons=self.get_main_menu_buttons()
@@ -267,44 +2890,12 @@ class WanVideoBot:
     
     async def start_mode(self, event, mode: str):
         """Start a generation mode"""
-        user_id = event.sender_id
-        
-        # Initialize user data based on mode
-        mode_configs = {
-            't2v': {
-                'type': 't2v',
-                'state': 't2v_prompt',
-                'title': '📝 **Text to Video**',
-                'prompt_text': 'Send me a descriptive prompt for your video.\n\nExample: `A beautiful sunset over the ocean with waves gently crashing`',
-                'data': {'width': 832, 'height': 480, 'num_frames': 121, 'steps': 30, 'cfg': 7.5, 'use_fast_mode': False}
-            },
-            'i2v': {
-                'type': 'i2v',
-                'state': 'i2v_image',
-                'title': '🖼️ **Image to Video**',
-                'prompt_text': 'Please send me an image that you want to animate.\n\nSupported: JPG, PNG, WebP\nMax size: 20MB',
-                'data': {'width': 1280, 'height': 704, 'num_frames': 81, 'steps': 20, 'cfg': 3.5, 'use_fast_mode': True}
-            },
-            'animate': {
-                'type': 'animate',
-                'state': 'animate_ref_image',
-                'title': '🎭 **Animate Character**',
-                'prompt_text': 'This transfers motion from a video to your character.\n\n**Step 1:** Send me a reference image of your character\n\nSupported: JPG, PNG, WebP\nMax size: 20MB',
-                'data': {'width': 640, 'height': 640, 'num_frames': 77, 'steps': 6, 'cfg': 1.0, 'use_fast_mode': True}
-            }
-        }
-        
-        config = mode_configs[mode]
-        self.user_states[user_id] = config['state']
-        self.user_data[user_id] = {
-            'type': config['type'],
-            'prompt': '',
-            'negative_prompt': '',
-            **config['data']
-        }
+        wizard = WIZARDS[mode]
+        self.sessions.start(event.sender_id, mode, wizard.steps[0], wizard.new_data())
         
-        await event.edit(
-            f"{config['title']}\n\n{config['prompt_text']}",
+        await self.edit(
+            event,
+            f"{wizard.title}\n\n{wizard.intro}",
             buttons=[
                 [Button.inline("🔙 Back", "main_menu")],
                 [Button.inline("❌ Cancel", "cancel")]
@@ -314,7 +2905,7 @@ class WanVideoBot:
     async def start_camera_selection(self, event):
         """Show camera motion selection"""
         user_id = event.sender_id
-        self.user_states[user_id] = 'camera_motion'
+        self.sessions.set_state(user_id, 'camera', Step.CAMERA_MOTION)
         
         buttons = []
         for i in range(0, len(self.camera_motions), 2):
@@ -328,31 +2919,22 @@ class WanVideoBot:
         
         buttons.append([Button.inline("🔙 Back", "main_menu")])
         
-        await event.edit(
-            "📹 **Camera Motion**\n\n"
-            "Select a camera motion to apply:",
+        wizard = WIZARDS['camera']
+        await self.edit(
+            event,
+            f"{wizard.title}\n\n{wizard.intro}",
             buttons=buttons
         )
     
     async def select_camera_motion(self, event, motion):
         """Select camera motion and proceed"""
-        user_id = event.sender_id
-        self.user_states[user_id] = 'camera_image'
-        self.user_data[user_id] = {
-            'type': 'camera',
-            'camera_motion': motion,
-            'lora_strength': 1.0,
-            'image_base64': '',
-            'prompt': '',
-            'negative_prompt': '',
-            'width': 1280,
-            'height': 704,
-            'num_frames': 81,
-            'steps': 20,
-            'cfg': 3.5
-        }
+        wizard = WIZARDS['camera']
+        data = wizard.new_data()
+        data['camera_motion'] = motion
+        self.sessions.start(event.sender_id, 'camera', wizard.transitions[Step.CAMERA_MOTION], data)
         
-        await event.edit(
+        await self.edit(
+            event,
             f"📹 **Camera Motion: {motion}**\n\n"
             "Now send me an image to apply this motion.\n\n"
             "Supported: JPG, PNG, WebP\nMax size: 20MB",
@@ -362,112 +2944,156 @@ class WanVideoBot:
             ]
         )
     
-    async def handle_prompt(self, event, mode: str):
+    async def handle_prompt(self, event, session: Session):
         """Handle prompt input"""
-        user_id = event.sender_id
         prompt = event.text.strip()
         
         if len(prompt) < 5:
-            await event.respond("⚠️ Prompt too short! Please provide more detail.")
+            await self.respond(event, "⚠️ Prompt too short! Please provide more detail.")
             return
         
-        self.user_data[user_id]['prompt'] = prompt
-        self.user_states[user_id] = f'{mode}_negative'
+        session.data['prompt'] = prompt
+        session.advance()
+        self.sessions.save(event.sender_id, session)
         
-        await event.respond(
+        await self.respond(
+            event,
             "✅ Prompt received!\n\n"
             "Send a negative prompt (what you DON'T want), or send /skip to continue.",
             buttons=[[Button.inline("Generate Now", "generate")]]
         )
     
-    async def handle_negative_prompt(self, event, mode: str):
+    async def handle_negative_prompt(self, event, session: Session):
         """Handle negative prompt input"""
-        user_id = event.sender_id
-        self.user_data[user_id]['negative_prompt'] = event.text.strip()
+        session.data['negative_prompt'] = event.text.strip()
+        self.sessions.save(event.sender_id, session)
         await self.show_generate_confirm(event)
     
-    async def handle_image(self, event, mode: str):
+    async def handle_image(self, event, session: Session):
         """Handle image upload"""
         user_id = event.sender_id
+        mode, step = session.mode, session.step
+        image = None
+        owned = False
         
         try:
-            if event.photo:
-                photo = await event.download_media(file=bytes)
-            elif event.document and event.document.mime_type in SUPPORTED_IMAGE_TYPES:
-                photo = await event.download_media(file=bytes)
-            else:
-                await event.respond("⚠️ Please send a valid image!")
+            if not (event.photo or (event.document and event.document.mime_type in SUPPORTED_IMAGE_TYPES)):
+                await self.respond(event, "⚠️ Please send a valid image!")
+                return
+            
+            if self.exceeds_size_limit(event):
+                await self.respond(event, "⚠️ Image too large! Max 20MB.")
                 return
             
-            if len(photo) > MAX_FILE_SIZE:
-                await event.respond("⚠️ Image too large! Max 20MB.")
+            image = await self.download_to_disk(event, user_id)
+            if image.size > MAX_FILE_SIZE:
+                await self.respond(event, "⚠️ Image too large! Max 20MB.")
                 return
             
-            image_b64 = base64.b64encode(photo).decode('utf-8')
+            session = self.sessions.get(user_id)
+            if session is not None and session.at(mode, step):
+                try:
+                    image = await self.prepare_image(image, session.data['width'], session.data['height'])
+                except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                    logger.info(f"Rejected unreadable image from user {user_id}: {e}")
+                    await self.respond(event, "⚠️ Could not read this image. Please send a JPG, PNG or WebP.")
+                    return
             
-            # Store image based on mode
-            if mode == 'animate_ref':
-                self.user_data[user_id]['reference_image_base64'] = image_b64
-                self.user_states[user_id] = 'animate_video'
-                await event.respond(
+            # Store image based on step
+            if step is Step.REFERENCE:
+                owned = await self.attach_media(event, 'reference_image_base64', image, mode, step)
+                if not owned:
+                    return
+                await self.respond(
+                    event,
                     "✅ Reference image received!\n\n"
                     "**Step 2:** Send a video with the motion to transfer.\n\n"
                     "Supported: MP4, WebM\nMax: 20MB"
                 )
             else:
-                self.user_data[user_id]['image_base64'] = image_b64
-                self.user_states[user_id] = f'{mode}_prompt'
-                await event.respond(
+                owned = await self.attach_media(event, 'image_base64', image, mode, step)
+                if not owned:
+                    return
+                await self.respond(
+                    event,
                     "✅ Image received!\n\n"
                     "Send a prompt describing how to animate it.\n\n"
                     "Example: `Camera slowly zooming in`"
                 )
         except Exception as e:
             logger.error(f"Image processing error: {e}", exc_info=True)
-            await event.respond("❌ Error processing image. Try again.")
+            await self.respond(event, "❌ Error processing image. Try again.")
+        finally:
+            # Whatever the session did not take is deleted, including on unexpected errors
+            if image is not None and not owned:
+                image.discard()
     
-    async def handle_video(self, event):
+    async def handle_video(self, event, session: Session):
         """Handle video upload for animate mode"""
         user_id = event.sender_id
+        mode, step = session.mode, session.step
+        video = None
+        owned = False
         
         try:
-            if event.video:
-                video = await event.download_media(file=bytes)
-            elif event.document and event.document.mime_type in SUPPORTED_VIDEO_TYPES:
-                video = await event.download_media(file=bytes)
-            else:
-                await event.respond("⚠️ Please send a valid video!")
+            if not (event.video or (event.document and event.document.mime_type in SUPPORTED_VIDEO_TYPES)):
+                await self.respond(event, "⚠️ Please send a valid video!")
+                return
+            
+            if self.exceeds_size_limit(event):
+                await self.respond(event, "⚠️ Video too large! Max 20MB.")
                 return
             
-            if len(video) > MAX_FILE_SIZE:
-                await event.respond("⚠️ Video too large! Max 20MB.")
+            video = await self.download_to_disk(event, user_id)
+            if video.size > MAX_FILE_SIZE:
+                await self.respond(event, "⚠️ Video too large! Max 20MB.")
                 return
             
-            video_b64 = base64.b64encode(video).decode('utf-8')
-            self.user_data[user_id]['video_base64'] = video_b64
-            self.user_states[user_id] = 'animate_prompt'
+            session = self.sessions.get(user_id)
+            if session is not None and session.at(mode, step):
+                data = session.data
+                try:
+                    video = await self.video_normalizer.normalize(
+                        video, data['width'], data['height'], data['num_frames']
+                    )
+                except ValueError:
+                    await self.respond(event, "⚠️ Could not read this video. Please send an MP4 or WebM.")
+                    return
+                except (asyncio.TimeoutError, RuntimeError, OSError) as e:
+                    # The backend accepted raw clips before, so fall back to the original upload
+                    logger.warning(f"Driving video normalization failed for user {user_id}: {e!r}")
+            
+            owned = await self.attach_media(event, 'video_base64', video, mode, step)
+            if not owned:
+                return
             
-            await event.respond(
+            await self.respond(
+                event,
                 "✅ Video received!\n\n"
                 "Send a prompt describing the animation.\n\n"
                 "Example: `Character dancing happily`"
             )
         except Exception as e:
             logger.error(f"Video error: {e}", exc_info=True)
-            await event.respond("❌ Error processing video.")
+            await self.respond(event, "❌ Error processing video.")
+        finally:
+            # Whatever the session did not take is deleted, including on unexpected errors
+            if video is not None and not owned:
+                video.discard()
     
     async def handle_skip(self, event):
         """Handle skip command"""
         user_id = event.sender_id
-        if user_id in self.user_states:
-            state = self.user_states[user_id]
-            if 'negative' in state:
-                self.user_data[user_id]['negative_prompt'] = ''
-                await self.show_generate_confirm(event)
+        session = self.sessions.get(user_id)
+        if session is not None and session.step is Step.NEGATIVE:
+            session.data['negative_prompt'] = ''
+            self.sessions.save(user_id, session)
+            await self.show_generate_confirm(event)
     
     async def show_generate_confirm(self, event):
         """Show generation confirmation"""
-        await event.respond(
+        await self.respond(
+            event,
             "✅ Ready to generate!\n\n"
             "Click below to start generation.",
             buttons=[[Button.inline("🎬 Generate Video", "generate")]]
@@ -477,115 +3103,377 @@ class WanVideoBot:
         """Generate video with rate limiting and queue management"""
         user_id = event.sender_id
         
-        if user_id not in self.user_data:
+        # Take the wizard data, including its media files, before any await so a double
+        # click cannot submit it twice; it is put back if the request is rejected
+        session = self.sessions.pop(user_id)
+        if session is None or not session.data:
+            if session is not None:
+                self.sessions.save(user_id, session)
             await event.answer("❌ No data found, please /start again.", alert=True)
             return
         
-        # Check rate limit
-        allowed, wait_time = self.rate_limiter.is_allowed(user_id)
-        if not allowed:
-            remaining = self.rate_limiter.get_remaining_requests(user_id)
+        data = session.data
+        if data['type'] not in ENDPOINT_PATHS:
+            self.sessions.save(user_id, session)
+            await self.respond(event, "❌ Invalid request type")
+            return
+        
+        # Identical requests are answered from the result cache without using quota
+        cache_key = result_cache_key(data['type'], {k: v for k, v in data.items() if k != 'type'})
+        cached_path = await self.result_cache.lookup(cache_key)
+        if cached_path:
+            discard_media(data)
+            await self.send_cached_result(event.chat_id, cache_key, cached_path)
+            return
+        
+        if self.intake_paused:
+            REQUESTS_REJECTED.inc('paused')
+            self.sessions.save(user_id, session)
+            await event.answer("⏸ New requests are paused for maintenance. Please try again later.", alert=True)
+            return
+        
+        # An identical job already in flight is joined instead of sent again
+        leader_id = await self.coordinator.find_inflight(cache_key)
+        
+        # Check queue; each tier may only fill its share of the holding queue
+        tier = self.user_tier(user_id)
+        if leader_id is None and self.task_queue.is_full(tier):
+            if await self.coordinator.backend_slots() >= self.task_queue.max_global:
+                REQUESTS_REJECTED.inc('queue_full')
+                self.sessions.save(user_id, session)
+                await event.answer("⏳ Server queue is full. Try again later.", alert=True)
+                return
+        mode = data['type']
+        cost = self.cost_model.estimate(mode, data)
+        if not await self.coordinator.acquire_user_slot(user_id, tier.max_tasks):
+            REQUESTS_REJECTED.inc('user_tasks')
+            self.sessions.save(user_id, session)
             await event.answer(
-                f"⏳ Rate limit reached!\n\n"
-                f"You can make {remaining} more request(s) in {wait_time} seconds.\n"
-                f"Limit: {MAX_REQUESTS_PER_HOUR} requests per hour.",
+                f"⏳ You already have {tier.max_tasks} task(s) in progress. Wait for them to finish.",
                 alert=True
             )
             return
         
-        # Check queue
-        can_add, reason = self.task_queue.can_add_task(user_id)
-        if not can_add:
-            await event.answer(f"⏳ {reason}", alert=True)
+        # Charge the user's quota with the job's estimated GPU-seconds
+        allowed, wait_time = await self.coordinator.acquire_request(user_id, cost)
+        if not allowed:
+            REQUESTS_REJECTED.inc('rate_limit')
+            await self.coordinator.release_user_slot(user_id)
+            self.sessions.save(user_id, session)
+            remaining = await self.coordinator.remaining_quota(user_id)
+            await event.answer(
+                f"⏳ GPU quota reached!\n\n"
+                f"This video needs ~{cost:.0f} GPU-seconds and you have {remaining:.0f} left; "
+                f"enough will be available in {wait_time} seconds.\n"
+                f"Quota: {USER_GPU_BUDGET:.0f} GPU-seconds per hour.",
+                alert=True
+            )
             return
         
         # Create task
         task_id = str(uuid.uuid4())
-        self.task_to_user[task_id] = user_id
-        
-        # Add to queue and rate limiter
-        self.task_queue.add_task(task_id, user_id)
-        self.rate_limiter.add_request(user_id)
         
-        data = self.user_data[user_id]
-        
-        # Build endpoint and payload
-        endpoint_map = {
-            't2v': f"{MODAL_API_URL}/api/generate/t2v",
-            'i2v': f"{MODAL_API_URL}/api/generate/i2v",
-            'animate': f"{MODAL_API_URL}/api/generate/animate",
-            'camera': f"{MODAL_API_URL}/api/generate/camera-lora"
-        }
+        # The leader may finish between the lookup and registration; then this request runs on its own
+        if leader_id is not None and await self.coordinator.register_task(
+            TaskRef(task_id, user_id, event.chat_id, leader_id=leader_id, cost=cost)
+        ):
+            discard_media(data)
+            self.throughput.record_submitted()
+            self.task_store.record_submit(
+                task_id, user_id, event.chat_id, mode, time.time(), 'pending', leader_id=leader_id, cost=cost
+            )
+            await self.send_message(
+                event.chat_id,
+                "✅ **Task accepted!**\n\n"
+                "An identical video is already being generated. "
+                "I will send it to you as soon as it is ready."
+            )
+            return
         
-        endpoint = endpoint_map.get(data['type'])
-        if not endpoint:
-            await event.respond("❌ Invalid request type")
-            self.task_queue.remove_task(task_id, user_id)
+        # Global admission is rationed by GPU-seconds, so heavy jobs use up more of the backend's budget
+        if not await self.coordinator.acquire_capacity(cost):
+            await self.coordinator.release_user_slot(user_id)
+            await self.coordinator.refund_request(user_id, cost)
+            REQUESTS_REJECTED.inc('capacity')
+            self.sessions.save(user_id, session)
+            await event.answer("⏳ The processing server is fully booked right now. Try again in a few minutes.", alert=True)
             return
         
         payload = {k: v for k, v in data.items() if k != 'type'}
         payload['webhook_url'] = self.WEBHOOK_URL
         payload['task_id'] = task_id
         
+        # Add to queue; held tasks go first so a free slot never jumps the line. The task is
+        # registered only once it is admitted, so no follower can join a request about to be rejected
+        started = not self.task_queue.waiting and await self.coordinator.acquire_backend_slot(
+            task_id, self.task_queue.max_global
+        )
+        if not started and self.task_queue.is_full(tier):
+            await self.coordinator.release_user_slot(user_id)
+            await self.coordinator.refund_request(user_id, cost)
+            await self.coordinator.refund_capacity(cost)
+            REQUESTS_REJECTED.inc('queue_full')
+            self.sessions.save(user_id, session)
+            await event.answer("⏳ Server queue is full. Try again later.", alert=True)
+            return
+        await self.coordinator.register_task(TaskRef(task_id, user_id, event.chat_id, cache_key, cost=cost))
+        
+        self.throughput.record_submitted()
+        self.task_work[task_id] = (mode, work_units(payload))
+        self.task_store.record_submit(
+            task_id, user_id, event.chat_id, mode, time.time(), 'submitting' if started else 'queued', cost=cost
+        )
+        
+        if started:
+            self.task_queue.mark_started(task_id)
+            await self.submit_task(task_id, user_id, mode, payload, event.chat_id, None)
+            return
+        
+        # Backend is at capacity: hold the task until a slot frees up
+        held = [mode, payload, event.chat_id, None]
+        self.held_tasks[task_id] = held
+        self.task_queue.hold(task_id, user_id, tier, max(cost / TASK_DURATION_ESTIMATE, 0.1))
+        position = self.task_queue.get_position(task_id) or 1
+        eta_minutes = max(1, round(self.task_queue.estimate_start(position) / 60))
         try:
-            queue_info = self.task_queue.get_queue_info(user_id)
-            remaining = self.rate_limiter.get_remaining_requests(user_id)
-            
-            processing_msg = await self.client.send_message(
+            held[3] = await self.send_message(
                 event.chat_id,
+                "⏳ **Task queued!**\n\n"
+                "The processing server is busy. Your task will be sent automatically when a slot frees up.\n\n"
+                f"📍 Queue position: {position}\n"
+                f"🕒 Estimated start: ~{eta_minutes} min"
+            )
+        except Exception as e:
+            logger.error(f"Failed to send queued message for task {task_id}: {e}")
+    
+    async def get_queue_info(self, user_id: int) -> Dict[str, int]:
+        """Queue and slot usage for status messages"""
+        return {
+            'global_queue': await self.coordinator.backend_slots(),
+            'waiting': len(self.task_queue.waiting),
+            'max_global': self.task_queue.max_global,
+            'user_tasks': await self.coordinator.user_slots(user_id),
+            'max_per_user': self.user_tier(user_id).max_tasks
+        }
+    
+    async def submit_task(self, task_id: str, user_id: int, mode: str, payload: Dict[str, Any],
+                          chat_id: int, processing_msg):
+        """Send a task to the backend and report the outcome to the user"""
+        try:
+            queue_info = await self.get_queue_info(user_id)
+            remaining = await self.coordinator.remaining_quota(user_id)
+            accepted_text = (
                 "✅ **Task accepted!**\n\n"
                 "Sending to processing server...\n\n"
                 f"📊 Queue: {queue_info['global_queue']}/{queue_info['max_global']}\n"
                 f"⏳ Your tasks: {queue_info['user_tasks']}/{queue_info['max_per_user']}\n"
-                f"🔄 Remaining requests: {remaining}/{MAX_REQUESTS_PER_HOUR}"
+                f"🔄 GPU quota left: {remaining:.0f}/{USER_GPU_BUDGET:.0f} s"
             )
+            if processing_msg:
+                await self.edit(processing_msg, accepted_text)
+            else:
+                processing_msg = await self.send_message(chat_id, accepted_text)
             
-            response = requests.post(endpoint, json=payload, timeout=30)
+            status_code, response_text = await self.submitter.submit(mode, payload)
             
-            if response.status_code == 200:
-                await processing_msg.edit(
+            if status_code == 200:
+                # The webhook may already have completed the task
+                if await self.coordinator.is_registered(task_id):
+                    self.task_store.update_status(task_id, 'pending')
+                    self.deadlines.schedule(task_id, time.monotonic() + task_timeout(payload))
+                await self.edit(
+                    processing_msg,
                     "🚀 **Task successfully submitted!**\n\n"
                     "Video is being processed. I will send it to you when done (usually 1-3 minutes).\n\n"
-                    f"📊 Queue position: {queue_info['global_queue']}/{queue_info['max_global']}\n"
+                    f"📊 Tasks on server: {queue_info['global_queue']}/{queue_info['max_global']}\n"
                     f"⏳ Your active tasks: {queue_info['user_tasks']}/{queue_info['max_per_user']}\n\n"
                     "You can start a new task if you want."
                 )
+                # Track progress only now, so this edit cannot overwrite an early progress update
+                if task_id in self.task_queue.started_at:
+                    self.progress.track(task_id, processing_msg)
             else:
-                error_msg = response.text[:500]
-                await processing_msg.edit(
+                error_msg = response_text[:500]
+                await self.edit(
+                    processing_msg,
                     f"❌ **Failed to submit task**\n\n"
-                    f"Status: {response.status_code}\n"
+                    f"Status: {status_code}\n"
                     f"Error: {error_msg}"
                 )
-                self.task_queue.remove_task(task_id, user_id)
-                del self.task_to_user[task_id]
+                await self.fail_submission(task_id, user_id, refund=True)
         
-        except requests.Timeout:
-            await processing_msg.edit("⏰ Server not responding. Failed to submit task. Try again later.")
-            self.task_queue.remove_task(task_id, user_id)
-            del self.task_to_user[task_id]
+        except BackendUnavailable:
+            await self.edit(
+                processing_msg,
+                "🔌 The processing server is unavailable right now. Try again in a minute.\n"
+                "This request did not count against your hourly limit."
+            )
+            await self.fail_submission(task_id, user_id, refund=True)
+        except asyncio.TimeoutError:
+            await self.edit(processing_msg, "⏰ Server not responding. Failed to submit task. Try again later.")
+            await self.fail_submission(task_id, user_id, refund=True)
         except Exception as e:
             logger.error(f"Submission error: {e}", exc_info=True)
-            await processing_msg.edit(f"❌ Error submitting: {str(e)[:200]}")
-            self.task_queue.remove_task(task_id, user_id)
-            del self.task_to_user[task_id]
+            if processing_msg:
+                await self.edit(processing_msg, f"❌ Error submitting: {str(e)[:200]}")
+            await self.fail_submission(task_id, user_id, refund=True)
+        finally:
+            discard_media(payload)
+    
+    async def send_cached_result(self, chat_id: int, cache_key: str, cached_path: str):
+        """Send a cached video, by Telegram file reference when one is known"""
+        caption = (
+            "✅ **Your video is ready!**\n\n"
+            "♻️ An identical request was generated recently, so this is the cached result.\n"
+            "It did not count against your hourly limit."
+        )
+        media = self.result_cache.uploads.get(cache_key)
+        if media is not None:
+            try:
+                await self.send_file(chat_id, media, caption=caption)
+                return
+            except errors.RPCError as e:
+                logger.info(f"Cached file reference unusable, re-uploading: {e}")
+                self.result_cache.forget_upload(cache_key)
+        
+        message = await self.send_file(
+            chat_id,
+            cached_path,
+            attributes=[DocumentAttributeFilename(f"video_{cache_key[:8]}.mp4")],
+            caption=caption
+        )
+        self.result_cache.remember_upload(cache_key, message.media)
+    
+    async def finish_task(self, task_id: str, user_id: int, followers: list[TaskRef], status: str,
+                          submitted_at: Optional[float] = None):
+        """Record a task's final status and free its slots and those of its followers"""
+        completed = status == 'completed'
+        now = time.time()
+        self.task_store.update_status(task_id, status)
+        self.throughput.record_finished(completed, now - submitted_at if submitted_at else None)
+        await self.coordinator.release_user_slot(user_id)
+        for follower in followers:
+            self.task_store.update_status(follower.task_id, status)
+            self.throughput.record_finished(completed, now - follower.submitted_at)
+            await self.coordinator.release_user_slot(follower.user_id)
+        self.forget_task(task_id, completed)
+        if await self.coordinator.release_backend_slot(task_id):
+            await self.dispatch_held()
+    
+    def forget_task(self, task_id: str, completed: bool) -> bool:
+        """Drop this replica's own state for a finished task. Returns False if it held none"""
+        known = (
+            task_id in self.task_queue.started_at or task_id in self.task_queue.waiting
+            or task_id in self.task_work or task_id in self.held_tasks
+        )
+        self.task_queue.discard(task_id)
+        self.deadlines.cancel(task_id)
+        self.progress.forget(task_id)
+        self.backend.forget(task_id)
+        held = self.held_tasks.pop(task_id, None)
+        if held is not None:
+            discard_media(held[1])
+        duration = self.task_queue.mark_finished(task_id, completed)
+        work = self.task_work.pop(task_id, None)
+        if duration is not None and work is not None:
+            self.cost_model.observe(*work, duration)
+        return known
+    
+    async def dispatch_held(self):
+        """Submit held tasks, oldest first, while the backend has free slots"""
+        async with self.dispatch_lock:
+            while self.task_queue.waiting:
+                next_id, next_user = self.task_queue.peek()
+                if not await self.coordinator.acquire_backend_slot(next_id, self.task_queue.max_global):
+                    return
+                self.task_queue.mark_started(next_id)
+                held = self.held_tasks.pop(next_id, None)
+                if held is None:
+                    logger.warning(f"Released task {next_id} has no held payload")
+                    self.spawn(self.fail_submission(next_id, next_user))
+                    continue
+                self.task_store.update_status(next_id, 'submitting')
+                self.spawn(self.submit_task(next_id, next_user, *held))
+    
+    async def dispatch_loop(self):
+        """Pick up backend slots freed by other replicas"""
+        while True:
+            await asyncio.sleep(DISPATCH_INTERVAL)
+            try:
+                await self.dispatch_held()
+            except Exception as e:
+                logger.error(f"Dispatch error: {e}")
+    
+    async def notify_followers(self, followers: list[TaskRef], text: str):
+        """Send the same message to every user waiting on a coalesced task"""
+        for follower in followers:
+            try:
+                await self.send_message(follower.user_id, text, priority=PRIORITY_RESULT)
+            except Exception as e:
+                logger.error(f"Error notifying user {follower.user_id}: {e}")
+    
+    async def fail_submission(self, task_id: str, user_id: int, refund: bool = False):
+        """Release a task that never reached the backend, optionally returning its rate-limit slots"""
+        claimed = await self.coordinator.claim_task(task_id)
+        if claimed is None:
+            # Already finished, e.g. cancelled by an admin while it was being submitted, or on another replica
+            if self.forget_task(task_id, False):
+                self.task_store.update_status(task_id, 'finished_elsewhere')
+            return
+        task, followers = claimed
+        await self.finish_task(task_id, user_id, followers, 'failed', task.submitted_at)
+        if refund:
+            await self.coordinator.refund_capacity(task.cost)
+            for recipient in [task] + followers:
+                await self.coordinator.refund_request(recipient.user_id, recipient.cost)
+                self.task_store.mark_refunded(recipient.task_id)
+        if followers:
+            self.spawn(self.notify_followers(
+                followers,
+                "❌ **Failed to submit task**\n\n"
+                "The identical request you joined could not be sent to the processing server. Please try again."
+            ))
+    
+    async def respond(self, event, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """event.respond through the outbound scheduler"""
+        return await self.outbound.submit(event.chat_id, lambda: event.respond(*args, **kwargs), priority)
+    
+    async def edit(self, target, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """Edit a message (or a callback's message) through the outbound scheduler"""
+        return await self.outbound.submit(target.chat_id, lambda: target.edit(*args, **kwargs), priority)
+    
+    async def send_message(self, chat_id: int, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """client.send_message through the outbound scheduler"""
+        return await self.outbound.submit(
+            chat_id, lambda: self.client.send_message(chat_id, *args, **kwargs), priority
+        )
+    
+    async def send_file(self, chat_id: int, file, *args, priority: int = PRIORITY_RESULT, **kwargs):
+        """client.send_file through the outbound scheduler; paths and streams count as uploads"""
+        upload = isinstance(file, (str, bytes, io.IOBase))
+        start = file.tell() if isinstance(file, io.IOBase) and file.seekable() else None
         
-        # Cleanup user data
-        if user_id in self.user_data:
-            del self.user_data[user_id]
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        def attempt():
+            # A FloodWait retry re-runs this, and the previous attempt may have read the stream
+            if start is not None:
+                file.seek(start)
+            return self.client.send_file(chat_id, file, *args, **kwargs)
+        return await self.outbound.submit(chat_id, attempt, priority, upload=upload)
+    
+    def spawn(self, coro) -> asyncio.Task:
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = self.client.loop.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
     
     async def cancel_operation(self, event):
         """Cancel current operation"""
         user_id = event.sender_id
+        self.sessions.clear(user_id)
         
-        if user_id in self.user_data:
-            del self.user_data[user_id]
-        if user_id in self.user_states:
-            del self.user_states[user_id]
-        
-        await event.edit(
+        await self.edit(
+            event,
             "❌ **Operation cancelled**\n\n"
             "Returning to main menu...",
             buttons=[[Button.inline("🔙 Main Menu", "main_menu")]]
@@ -593,7 +3481,8 @@ class WanVideoBot:
     
     async def show_help(self, event):
         """Show help menu"""
-        await event.edit(
+        await self.edit(
+            event,
             "🤖 **Bot Help**\n\n"
             "**Features:**\n"
             "• 📝 Text to Video\n"
@@ -606,8 +3495,8 @@ class WanVideoBot:
             "3. Wait 1-3 minutes\n"
             "4. Download video!\n\n"
             "**Limits:**\n"
-            f"• Max {MAX_REQUESTS_PER_HOUR} videos per hour\n"
-            f"• Max {CONCURRENT_TASKS_PER_USER} concurrent task\n"
+            f"• {USER_GPU_BUDGET:.0f} GPU-seconds per hour; bigger videos use more\n"
+            f"• Max {self.user_tier(event.sender_id).max_tasks} concurrent task(s)\n"
             "• Max 20MB file size\n\n"
             "**Tips:**\n"
             "• Use descriptive prompts\n"
@@ -618,7 +3507,8 @@ class WanVideoBot:
     
     async def show_help_message(self, event):
         """Show help as new message"""
-        await event.respond(
+        await self.respond(
+            event,
             "🤖 **Bot Help**\n\n"
             "**Features:**\n"
             "• 📝 Text to Video\n"
@@ -626,123 +3516,709 @@ class WanVideoBot:
             "• 🎭 Animate Character\n"
             "• 📹 Camera Motion\n\n"
             f"**Limits:**\n"
-            f"• {MAX_REQUESTS_PER_HOUR} videos per hour\n"
-            f"• {CONCURRENT_TASKS_PER_USER} concurrent task per user\n\n"
+            f"• {USER_GPU_BUDGET:.0f} GPU-seconds per hour; bigger videos use more\n"
+            f"• {self.user_tier(event.sender_id).max_tasks} concurrent task(s) for you\n\n"
             "Use /start to begin!",
             buttons=[[Button.inline("🔙 Main Menu", "main_menu")]]
         )
     
+    def is_admin(self, event) -> bool:
+        return bool(ADMIN_ID) and event.sender_id == ADMIN_ID
+    
+    def user_tier(self, user_id: int) -> Tier:
+        """Scheduling tier of a user"""
+        if ADMIN_ID and user_id == ADMIN_ID:
+            return self.tiers['admin']
+        if user_id in PREMIUM_USER_IDS:
+            return self.tiers['premium']
+        return self.tiers['free']
+    
+    async def handle_admin(self, event):
+        """Admin: dashboard and bulk controls"""
+        if not self.is_admin(event):
+            return
+        args = (event.pattern_match.group(1) or '').split()
+        command = args[0] if args else 'dashboard'
+        
+        if command == 'dashboard':
+            await self.respond(event, await self.admin_dashboard())
+        elif command in ('pause', 'resume'):
+            self.intake_paused = command == 'pause'
+            await self.respond(event, "⏸ Intake paused." if self.intake_paused else "▶️ Intake resumed.")
+        elif command == 'drain':
+            self.intake_paused = True
+            cancelled = 0
+            for task_id in list(self.task_queue.waiting):
+                cancelled += await self.cancel_task(
+                    task_id,
+                    "⚠️ Your queued task was cancelled because the server is being drained. "
+                    "It did not count against your hourly limit."
+                )
+            await self.respond(
+                event,
+                f"🚰 Intake paused and {cancelled} held task(s) cancelled. "
+                f"{len(self.task_queue.started_at)} running task(s) will finish normally."
+            )
+        elif command == 'limit' and len(args) == 3 and (args[1] == 'global' or args[1] in self.tiers) and args[2].isdigit():
+            value = max(1, int(args[2]))
+            if args[1] == 'global':
+                self.task_queue.max_global = value
+                await self.dispatch_held()
+            else:
+                self.tiers[args[1]].max_tasks = value
+            await self.respond(event, f"✅ {args[1].capitalize()} limit set to {value}.")
+        elif command == 'weight' and len(args) == 3 and args[1] in self.tiers and args[2].replace('.', '', 1).isdigit():
+            self.tiers[args[1]].weight = max(0.1, float(args[2]))
+            await self.respond(event, f"✅ {args[1].capitalize()} weight set to {self.tiers[args[1]].weight:g}.")
+        elif command == 'cancel' and (len(args) == 2 or (
+            len(args) == 3 and args[1] == 'stuck' and args[2].replace('.', '', 1).isdigit()
+        )):
+            if args[1] == 'stuck':
+                minutes = float(args[2]) if len(args) == 3 else 15.0
+                cutoff = time.monotonic() - minutes * 60
+                stuck = [task_id for task_id, started in self.task_queue.started_at.items() if started < cutoff]
+            else:
+                known = list(self.task_queue.started_at) + list(self.task_queue.waiting)
+                stuck = [task_id for task_id in known if task_id.startswith(args[1])] or [args[1]]
+            cancelled = 0
+            for task_id in stuck:
+                cancelled += await self.cancel_task(
+                    task_id,
+                    "⚠️ Your task was cancelled by an administrator because it was taking too long. "
+                    "It did not count against your hourly limit."
+                )
+            await self.respond(event, f"🗑 Cancelled {cancelled} task(s).")
+        else:
+            await self.respond(
+                event,
+                "Usage: /admin [dashboard | pause | resume | drain | limit global|admin|premium|free N | "
+                "weight admin|premium|free W | "
+                "cancel <task_id> | cancel stuck [minutes]]"
+            )
+    
+    async def admin_dashboard(self) -> str:
+        """Live throughput, latency, backend and queue overview"""
+        submitted, completed, failed = self.throughput.totals(5)
+        hour_submitted, hour_completed, hour_failed = self.throughput.totals(60)
+        p50, p95 = self.throughput.percentiles(0.5, 0.95)
+        finished = hour_completed + hour_failed
+        success_rate = f"{100 * hour_completed / finished:.0f}%" if finished else "n/a"
+        sessions = self.sessions.stats()
+        running = await self.coordinator.backend_slots()
+        
+        lines = [
+            "🛠 **Admin dashboard**\n",
+            f"Intake: {'⏸ paused' if self.intake_paused else '▶️ open'}",
+            f"📈 Last 5 min: {submitted / 5:.1f} submitted/min, {completed / 5:.1f} completed/min, "
+            f"{failed / 5:.1f} failed/min",
+            f"⏱ End-to-end: p50 {p50 or 0:.0f}s, p95 {p95 or 0:.0f}s "
+            f"({len(self.throughput.durations)} recent)",
+            f"✅ Task success (60 min): {success_rate} of {finished}, {hour_submitted} submitted",
+        ]
+        for backend in self.backend.stats():
+            error_rate = backend['errors'] / backend['requests'] if backend['requests'] else 0.0
+            lines.append(
+                f"🔌 {backend['url']}: {backend['state']}, {backend['outstanding']} in flight, "
+                f"{backend['ewma_latency']}s, {100 * (1 - error_rate):.0f}% ok"
+            )
+        lines += [
+            f"🧠 Sessions: {sessions['sessions']} holding {sessions['bytes_held'] / 1024 / 1024:.1f} MB "
+            f"of {SESSION_MEMORY_BUDGET / 1024 / 1024:.0f} MB",
+            f"📊 Backend slots: {running}/{self.task_queue.max_global}, held: {len(self.task_queue.waiting)}",
+            f"💸 GPU budget: {await self.coordinator.remaining_capacity():.0f}/{GLOBAL_GPU_BURST:.0f} s, "
+            f"refill {GLOBAL_GPU_RATE:g}/s; cost model " + ', '.join(
+                f"{mode} {stats['seconds_per_unit'] * 1000:.1f} ms/unit ({stats['samples']})"
+                for mode, stats in self.cost_model.stats().items()
+            ),
+            "🏷 Tiers: " + ', '.join(
+                f"{tier.name} ×{tier.weight:g} {tier.max_tasks}/user {self.task_queue.held_by_tier[tier.name]} held"
+                for tier in self.tiers.values()
+            ),
+        ]
+        
+        now = time.monotonic()
+        for task_id, started in list(self.task_queue.started_at.items())[:10]:
+            lines.append(f"  🚀 `{task_id[:8]}` running {(now - started) / 60:.1f} min")
+        for position, (task_id, user_id) in enumerate(self.task_queue.order()[:10], 1):
+            lines.append(f"  ⏳ #{position} `{task_id[:8]}` user {user_id} ({self.user_tier(user_id).name})")
+        return '\n'.join(lines)
+    
+    async def cancel_task(self, task_id: str, text: str) -> bool:
+        """Give up on a task: ignore its webhook, free its slots, refund and notify everyone waiting on it"""
+        claimed = await self.coordinator.claim_task(task_id)
+        if claimed is None:
+            # Another replica already took its webhook and freed the shared slots; only local state is left
+            if self.forget_task(task_id, False):
+                self.task_store.update_status(task_id, 'finished_elsewhere')
+            return False
+        task, followers = claimed
+        await self.finish_task(task.task_id, task.user_id, followers, 'failed', task.submitted_at)
+        await self.coordinator.refund_capacity(task.cost)
+        for recipient in [task] + followers:
+            await self.coordinator.refund_request(recipient.user_id, recipient.cost)
+            self.task_store.mark_refunded(recipient.task_id)
+        await self.notify_followers([task] + followers, text)
+        return True
+    
+    async def handle_profile(self, event):
+        """Admin: /profile start [seconds] | stop | dump"""
+        if not self.is_admin(event):
+            return
+        action = event.pattern_match.group(1) or 'dump'
+        seconds = event.pattern_match.group(2)
+        
+        if action == 'start':
+            self.watchdog.start_profiling()
+            if seconds:
+                self.spawn(self.finish_profile(event.chat_id, int(seconds)))
+                await self.respond(event, f"🔬 Profiling the event loop for {seconds}s...")
+            else:
+                await self.respond(event, "🔬 Profiling started. Send /profile stop to get the report.")
+        elif action == 'stop':
+            self.watchdog.stop_profiling()
+            await self.send_profile(event.chat_id)
+        elif action == 'dump':
+            await self.send_profile(event.chat_id)
+        else:
+            await self.respond(event, "Usage: /profile start [seconds] | stop | dump")
+    
+    async def finish_profile(self, chat_id: int, seconds: int):
+        await asyncio.sleep(seconds)
+        self.watchdog.stop_profiling()
+        await self.send_profile(chat_id)
+    
+    async def send_profile(self, chat_id: int):
+        """Send the hottest loop stacks, plus all of them in folded format for flame graph tools"""
+        samples, elapsed = self.watchdog.profile_snapshot()
+        total = sum(samples.values())
+        if not total:
+            await self.send_message(chat_id, "🔬 No profile samples collected.")
+            return
+        
+        lines = [f"🔬 **Loop profile**: {total} samples over {elapsed:.1f}s\n"]
+        for stack, count in samples.most_common(10):
+            leaf = ' ← '.join(reversed(stack.split(';')[-3:]))
+            lines.append(f"`{100 * count / total:5.1f}%` {leaf}")
+        await self.send_message(chat_id, '\n'.join(lines))
+        
+        folded = io.BytesIO(''.join(f"{stack} {count}\n" for stack, count in samples.items()).encode('utf-8'))
+        folded.name = 'loop_profile.folded'
+        await self.send_file(chat_id, folded, force_document=True, priority=PRIORITY_INTERACTIVE)
+    
+    async def show_stalls(self, event):
+        """Admin: recent event loop stalls"""
+        if not self.is_admin(event):
+            return
+        if not self.watchdog.stalls:
+            await self.respond(event, f"✅ No event loop stalls over {LOOP_STALL_THRESHOLD}s recorded.")
+            return
+        
+        lines = ["🐢 **Recent event loop stalls**\n"]
+        for stall in list(self.watchdog.stalls)[-10:]:
+            duration = f"{stall['duration']:.2f}s" if stall['duration'] is not None else 'ongoing'
+            at = time.strftime('%H:%M:%S', time.localtime(stall['at']))
+            lines.append(f"• {at} {duration} in `{stall['handler'] or 'unknown'}`")
+        lines.append(f"\n```\n{self.watchdog.stalls[-1]['stack'][-3000:]}```")
+        await self.respond(event, '\n'.join(lines))
+    
     async def show_stats(self, event):
         """Show user statistics"""
         user_id = event.sender_id
-        queue_info = self.task_queue.get_queue_info(user_id)
-        remaining = self.rate_limiter.get_remaining_requests(user_id)
+        queue_info = await self.get_queue_info(user_id)
+        remaining = await self.coordinator.remaining_quota(user_id)
         
-        await event.respond(
+        await self.respond(
+            event,
             "📊 **Your Statistics**\n\n"
-            f"🔄 Remaining requests: {remaining}/{MAX_REQUESTS_PER_HOUR}\n"
+            f"🏷 Tier: {self.user_tier(user_id).name}\n"
+            f"🔄 GPU quota left: {remaining:.0f}/{USER_GPU_BUDGET:.0f} s\n"
             f"⏳ Your active tasks: {queue_info['user_tasks']}/{queue_info['max_per_user']}\n"
-            f"📊 Global queue: {queue_info['global_queue']}/{queue_info['max_global']}\n\n"
-            f"Rate limit resets every hour.",
+            f"📊 Global queue: {queue_info['global_queue']}/{queue_info['max_global']}\n"
+            f"🕒 Waiting for a slot: {queue_info['waiting']}\n"
+            "💸 Cost per video: " + ', '.join(
+                f"{mode} ~{self.cost_model.estimate(mode, wizard.defaults):.0f}s" for mode, wizard in WIZARDS.items()
+            ) + "\n\n"
+            "Your GPU quota refills continuously over an hour.",
             buttons=[[Button.inline("🔙 Main Menu", "main_menu")]]
         )
     
-    def run(self):
-        """Run the bot"""
-        logger.info("Bot started!")
-        self.client.run_until_disconnected()
-
-# Flask webhook server
-flask_app = Flask(__name__)
-bot_instance = None
-
-@flask_app.route('/webhook', methods=['POST'])
-def handle_webhook():
-    """Handle webhook from Modal server"""
-    global bot_instance
-    if not bot_instance:
-        return jsonify({"status": "error", "message": "Bot not initialized"}), 500
-    
-    data = request.json
-    task_id = data.get('task_id')
-    status = data.get('status')
-    
-    if not task_id or task_id not in bot_instance.task_to_user:
-        logger.warning(f"Webhook received for unknown task_id: {task_id}")
-        return jsonify({"status": "ignored", "reason": "unknown task_id"}), 200
+    async def result_caption(self, user_id: int) -> str:
+        """Caption for a delivered video"""
+        queue_info = await self.get_queue_info(user_id)
+        remaining = await self.coordinator.remaining_quota(user_id)
+        return (
+            "✅ **Your video is ready!**\n\n"
+            f"📊 Queue: {queue_info['global_queue']}/{queue_info['max_global']}\n"
+            f"🔄 GPU quota left: {remaining:.0f}/{USER_GPU_BUDGET:.0f} s"
+        )
     
-    user_id = bot_instance.task_to_user.get(task_id)
+    async def send_video(self, user_id: int, task_id: str, video_path: str, media=None):
+        """Send a video by Telegram file reference if given, else upload it. Returns the media sent"""
+        if media is not None:
+            try:
+                await self.send_file(user_id, media, caption=await self.result_caption(user_id))
+                return media
+            except errors.RPCError as e:
+                logger.info(f"File reference unusable, re-uploading: {e}")
+        
+        # Telethon uploads from the path in chunks, so the video is never held in memory
+        caption = await self.result_caption(user_id)
+        started = time.perf_counter()
+        message = await self.send_file(
+            user_id,
+            video_path,
+            attributes=[DocumentAttributeFilename(f"video_{task_id[:8]}.mp4")],
+            caption=caption
+        )
+        UPLOAD_LATENCY.observe(time.perf_counter() - started)
+        UPLOAD_BYTES.inc(amount=os.path.getsize(video_path))
+        return message.media
     
-    async def send_result():
+    async def deliver_result(self, task: TaskRef, followers: list[TaskRef], data: Dict[str, Any],
+                             video_path: Optional[str], received_at: Optional[float] = None):
+        """Send a finished (or failed) task result to the user and to any coalesced requests"""
+        status = data.get('status')
+        success = status == 'success' and video_path is not None
+        cache_key = task.cache_key
+        cached = False
         try:
-            if status == 'success':
-                video_b64 = data.get('video_base64')
-                video_bytes = base64.b64decode(video_b64)
-                video_file = io.BytesIO(video_bytes)
-                video_file.name = f"video_{task_id[:8]}.mp4"
+            if success:
+                # The cache takes ownership of the file, so repeats of this request skip the backend
+                if cache_key:
+                    video_path = await self.result_cache.store(cache_key, video_path)
+                    cached = True
                 
-                queue_info = bot_instance.task_queue.get_queue_info(user_id)
-                remaining = bot_instance.rate_limiter.get_remaining_requests(user_id)
-                
-                await bot_instance.client.send_file(
-                    user_id,
-                    video_file,
-                    caption=(
-                        "✅ **Your video is ready!**\n\n"
-                        f"📊 Queue: {queue_info['global_queue']}/{queue_info['max_global']}\n"
-                        f"🔄 Remaining requests: {remaining}/{MAX_REQUESTS_PER_HOUR}"
-                    )
-                )
+                # Upload once, then fan out by file reference
+                media = None
+                for recipient in [task] + followers:
+                    try:
+                        media = await self.send_video(recipient.user_id, recipient.task_id, video_path, media)
+                    except Exception as e:
+                        logger.error(f"Error sending result to user {recipient.user_id}: {e}")
+                if cache_key:
+                    self.result_cache.remember_upload(cache_key, media)
+                if received_at is not None:
+                    DELIVERY_LATENCY.observe(time.monotonic() - received_at)
             else:
-                error_detail = data.get('detail', 'Unknown error')
-                await bot_instance.client.send_message(
-                    user_id,
+                error_detail = data.get('detail', 'Unknown error' if status != 'success' else 'No video in result')
+                error_text = (
                     f"❌ **Sorry, an error occurred while processing your video.**\n\n"
                     f"Detail: `{error_detail}`\n\n"
                     "Please try again or contact support if the problem persists."
                 )
+                await self.notify_followers([task] + followers, error_text)
         except Exception as e:
-            logger.error(f"Error sending result to user {user_id}: {e}")
+            logger.error(f"Error sending result to user {task.user_id}: {e}")
         finally:
             # Remove task from queue
-            bot_instance.task_queue.remove_task(task_id, user_id)
-            if task_id in bot_instance.task_to_user:
-                del bot_instance.task_to_user[task_id]
+            await self.finish_task(
+                task.task_id, task.user_id, followers, 'completed' if success else 'failed', task.submitted_at
+            )
+            if video_path and not cached:
+                remove_file(video_path)
+    
+    def record_progress(self, data: Dict[str, Any]) -> bool:
+        """Apply a progress webhook. Returns False if the task's status message is not on this replica"""
+        task_id = data.get('task_id')
+        if not task_id or not self.progress.update(task_id, progress_text(data)):
+            return False
+        # Progress proves the job is alive, so keep its deadline ahead of it
+        self.deadlines.postpone(task_id, time.monotonic() + TASK_TIMEOUT_EXTENSION)
+        return True
+    
+    async def reap_stuck_tasks(self):
+        """Expire tasks whose webhook never arrived, unless the backend says they are still running"""
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            for task_id, extensions in self.deadlines.pop_expired(time.monotonic()):
+                try:
+                    await self.expire_task(task_id, extensions)
+                except Exception as e:
+                    logger.error(f"Error expiring task {task_id}: {e}", exc_info=True)
+    
+    async def expire_task(self, task_id: str, extensions: int):
+        status = await self.backend.status(task_id)
+        if status in ('queued', 'pending', 'running', 'processing', 'in_progress') and extensions < TASK_MAX_EXTENSIONS:
+            logger.info(f"Task {task_id} is past its deadline but still {status}; extending")
+            self.deadlines.schedule(task_id, time.monotonic() + TASK_TIMEOUT_EXTENSION, extensions + 1)
+            return
+        
+        if await self.cancel_task(
+            task_id,
+            "⌛ **Your video timed out.**\n\n"
+            "The processing server did not return a result in time. "
+            "This request did not count against your hourly limit, please try again."
+        ):
+            TASKS_EXPIRED.inc()
+            logger.warning(f"Task {task_id} expired without a webhook (backend status: {status})")
+    
+    async def housekeeping(self):
+        """Periodically drop expired wizard sessions and old rate-limit entries"""
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            self.sessions.sweep()
+            try:
+                await self.coordinator.sweep()
+            except Exception as e:
+                logger.error(f"Coordinator sweep failed: {e}")
+    
+    async def start(self):
+        """Start the webhook server and background workers on the running loop"""
+        await self.webhook_server.start()
+        self.workers = [
+            asyncio.create_task(self.housekeeping()),
+            asyncio.create_task(self.backend.probe_loop()),
+            asyncio.create_task(self.watchdog.heartbeat()),
+            asyncio.create_task(self.reap_stuck_tasks()),
+            asyncio.create_task(self.progress.run()),
+            asyncio.create_task(self.outbound.run())
+        ]
+        if self.coordinator.shared:
+            self.workers.append(asyncio.create_task(self.dispatch_loop()))
+        self.watchdog.start()
+    
+    async def stop(self):
+        """Stop workers and release connections, threads and the task store
+
+        Webhooks stop first, and deliveries and background tasks are drained
+        while the outbound scheduler still runs, because they send through it.
+        """
+        self.watchdog.stop()
+        await self.webhook_server.stop(SHUTDOWN_GRACE)
+        await finish_or_cancel(self.background_tasks, SHUTDOWN_GRACE)
+        if isinstance(self.submitter, SubmissionBatcher):
+            await self.submitter.close()
+        await self.outbound.close()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await self.backend.close()
+        self.image_pool.shutdown(wait=False, cancel_futures=True)
+        self.task_store.close()
+    
+    def run(self):
+        """Run the bot"""
+        loop = self.client.loop
+        loop.run_until_complete(self.start())
+        logger.info("Bot started!")
+        try:
+            self.client.run_until_disconnected()
+        finally:
+            loop.run_until_complete(self.stop())
+
+class Base64FieldExtractor:
+    """Splits a streamed JSON body, decoding one large base64 string field straight to a file
+
+    Everything outside the field is buffered and parsed with json at the end; the field's
+    value is replaced by null. Unescaped quotes in JSON text are always structural, so a
+    match of `{"field": "` or `, "field": "` can only be the real key.
+    """
+    SCAN_OVERLAP = 256
+    
+    def __init__(self, field: str, sink):
+        self.sink = sink
+        self.decoded_size = 0
+        self.found = False
+        self._key = re.compile(rb'[{,]\s*"' + re.escape(field.encode('utf-8')) + rb'"\s*:\s*"')
+        self._rest = bytearray()
+        self._scan_from = 0
+        self._in_field = False
+        self._pending = b''
+    
+    def feed(self, chunk: bytes):
+        """Consume the next chunk of the body"""
+        while chunk:
+            if self._in_field:
+                end = chunk.find(b'"')
+                self._decode(chunk if end < 0 else chunk[:end])
+                if end < 0:
+                    return
+                self._finish_field()
+                chunk = chunk[end + 1:]
+                continue
+            
+            self._rest += chunk
+            if self.found:
+                return
+            match = self._key.search(self._rest, self._scan_from)
+            if not match:
+                self._scan_from = max(0, len(self._rest) - self.SCAN_OVERLAP)
+                return
+            chunk = bytes(self._rest[match.end():])
+            del self._rest[match.end() - 1:]
+            self._in_field = True
+            self.found = True
     
-    # Run async function from Flask
-    asyncio.run_coroutine_threadsafe(send_result(), bot_instance.client.loop)
+    def _decode(self, part: bytes):
+        """Decode base64 text, carrying incomplete quads and escapes to the next chunk"""
+        data = self._pending + part
+        if data.endswith(b'\\'):
+            data, self._pending = data[:-1], b'\\'
+        else:
+            self._pending = b''
+        if b'\\' in data:
+            data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        usable = len(data) - len(data) % 4
+        if usable:
+            decoded = binascii.a2b_base64(data[:usable])
+            self.sink.write(decoded)
+            self.decoded_size += len(decoded)
+        self._pending = data[usable:] + self._pending
     
-    return jsonify({"status": "received"}), 200
+    def _finish_field(self):
+        """Flush the final quad and put a placeholder where the value was"""
+        tail = self._pending.rstrip(b'\\')
+        if tail:
+            decoded = binascii.a2b_base64(tail + b'=' * (-len(tail) % 4))
+            self.sink.write(decoded)
+            self.decoded_size += len(decoded)
+        self._pending = b''
+        self._in_field = False
+        self._rest += b'null'
+    
+    def result(self) -> Dict[str, Any]:
+        """Parse the JSON text outside the extracted field"""
+        if self._in_field:
+            raise ValueError("Unterminated base64 field")
+        return json.loads(bytes(self._rest))
 
-@flask_app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    global bot_instance
-    if not bot_instance:
-        return jsonify({"status": "error", "message": "Bot not initialized"}), 500
+# Webhook server
+class WebhookServer:
+    """aiohttp server for backend webhooks, running on the bot's own event loop"""
+    def __init__(self, bot: 'WanVideoBot', port: int, max_body: int, max_concurrency: int, acquire_timeout: float):
+        self.bot = bot
+        self.port = port
+        self.max_body = max_body
+        self.acquire_timeout = acquire_timeout
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.deliveries = set()
+        self.runner: Optional[web.AppRunner] = None
+        
+        self.app = web.Application(client_max_size=max_body)
+        self.app.router.add_post('/webhook', self.handle_webhook)
+        self.app.router.add_get('/health', self.health_check)
+        self.app.router.add_get('/metrics', self.metrics)
+    
+    async def start(self):
+        """Start listening for webhooks"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '0.0.0.0', self.port).start()
+        logger.info(f"Webhook server listening on port {self.port}")
+    
+    async def stop(self, grace: float):
+        """Stop accepting webhooks, then give in-flight deliveries `grace` seconds before cancelling them"""
+        if self.runner:
+            await self.runner.cleanup()
+        await finish_or_cancel(self.deliveries, grace)
     
-    return jsonify({
-        "status": "healthy",
-        "bot_running": True,
-        "webhook_url": bot_instance.WEBHOOK_URL
-    }), 200
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Handle webhook from Modal server
 
-def run_flask():
-    """Run Flask server"""
-    port = int(os.environ.get("PORT", 8080))
-    flask_app.run(host="0.0.0.0", port=port, debug=False)
+        Accepts JSON with a base64 `video_base64` field, a raw video body with
+        X-Task-Id/X-Status headers, or multipart/form-data with a `video` file part.
+        The video is decoded incrementally into a spool file on disk.
+        Bodies with a status in PROGRESS_STATUSES are progress events; they
+        update the user's status message and never claim the task. Small JSON
+        ones are recognised before taking a delivery slot.
+        """
+        received_at = time.monotonic()
+        if request.content_length is not None and request.content_length > self.max_body:
+            WEBHOOK_TOTAL.inc('too_large')
+            return web.json_response({"status": "error", "message": "Payload too large"}, status=413)
+        
+        content_type = request.content_type
+        raw_body = content_type.startswith('video/') or content_type == 'application/octet-stream'
+        small = None
+        small_json = content_type == 'application/json' and request.content_length is not None
+        if small_json and request.content_length <= PROGRESS_MAX_BODY:
+            try:
+                small = json.loads(await request.read())
+            except ValueError:
+                WEBHOOK_TOTAL.inc('invalid')
+                return web.json_response({"status": "error", "message": "Invalid body"}, status=400)
+            if isinstance(small, dict) and small.get('status') in PROGRESS_STATUSES:
+                return self._progress(small)
+        if raw_body:
+            task_id = request.headers.get('X-Task-Id') or request.query.get('task_id')
+            if not task_id or not await self.bot.coordinator.is_registered(task_id):
+                logger.warning(f"Webhook received for unknown task_id: {task_id}")
+                WEBHOOK_TOTAL.inc('unknown_task')
+                return web.json_response({"status": "ignored", "reason": "unknown task_id"})
+        
+        # Bound the number of deliveries in flight; excess callers are told to retry
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook rejected: all delivery slots busy")
+            WEBHOOK_TOTAL.inc('busy')
+            return web.json_response(
+                {"status": "busy", "message": "Too many deliveries in progress"},
+                status=503,
+                headers={'Retry-After': '5'}
+            )
+        
+        delivery = None
+        video_path = os.path.join(RESULT_TMP_DIR, f"{uuid.uuid4().hex}.mp4")
+        try:
+            try:
+                if small is not None:
+                    data, has_video = self._unpack_small_json(small, video_path)
+                elif raw_body:
+                    data, has_video = await self._read_raw(request, video_path)
+                elif content_type.startswith('multipart/'):
+                    data, has_video = await self._read_multipart(request, video_path)
+                else:
+                    data, has_video = await self._read_json(request, video_path)
+            except web.HTTPRequestEntityTooLarge:
+                WEBHOOK_TOTAL.inc('too_large')
+                return web.json_response({"status": "error", "message": "Payload too large"}, status=413)
+            except (ValueError, binascii.Error):
+                WEBHOOK_TOTAL.inc('invalid')
+                return web.json_response({"status": "error", "message": "Invalid body"}, status=400)
+            
+            # Chunked or unusually large progress events only show up once parsed; they must never finish the task
+            if isinstance(data, dict) and data.get('status') in PROGRESS_STATUSES:
+                return self._progress(data)
+            
+            # Claim the task so a repeated webhook, on this replica or another, cannot deliver it twice
+            task_id = data.get('task_id') if isinstance(data, dict) else None
+            claimed = await self.bot.coordinator.claim_task(task_id) if task_id else None
+            if claimed is None:
+                logger.warning(f"Webhook received for unknown task_id: {task_id}")
+                WEBHOOK_TOTAL.inc('unknown_task')
+                return web.json_response({"status": "ignored", "reason": "unknown task_id"})
+            
+            task, followers = claimed
+            delivery = asyncio.create_task(
+                self.bot.deliver_result(task, followers, data, video_path if has_video else None, received_at)
+            )
+            WEBHOOK_TOTAL.inc('accepted')
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self._delivery_done)
+            return web.json_response({"status": "received"})
+        finally:
+            if delivery is None:
+                self.slots.release()
+                remove_file(video_path)
+    
+    def _progress(self, data: Dict[str, Any]) -> web.Response:
+        """Apply a progress event to the task's status message"""
+        WEBHOOK_TOTAL.inc('progress')
+        if self.bot.record_progress(data):
+            return web.json_response({"status": "received"})
+        return web.json_response({"status": "ignored", "reason": "no status message for task_id"})
+    
+    def _unpack_small_json(self, data, video_path: str) -> tuple[Dict[str, Any], bool]:
+        """Decode `video_base64` from an already parsed small body"""
+        if not isinstance(data, dict):
+            raise ValueError("Webhook body is not an object")
+        encoded = data.pop('video_base64', None)
+        if not isinstance(encoded, str) or not encoded:
+            return data, False
+        with open(video_path, 'wb') as sink:
+            sink.write(base64.b64decode(encoded))
+        return data, True
+    
+    async def _read_json(self, request: web.Request, video_path: str) -> tuple[Dict[str, Any], bool]:
+        """Read a JSON body, decoding `video_base64` to video_path as it streams in"""
+        received = 0
+        with open(video_path, 'wb') as sink:
+            extractor = Base64FieldExtractor('video_base64', sink)
+            async for chunk in request.content.iter_chunked(WEBHOOK_READ_CHUNK):
+                received += len(chunk)
+                if received > self.max_body:
+                    raise web.HTTPRequestEntityTooLarge(max_size=self.max_body, actual_size=received)
+                extractor.feed(chunk)
+            data = extractor.result()
+            
+            # Fall back for bodies where the field could not be located while streaming
+            if isinstance(data, dict) and isinstance(data.get('video_base64'), str):
+                sink.write(base64.b64decode(data.pop('video_base64')))
+                return data, True
+        return data, extractor.found and extractor.decoded_size > 0
+    
+    async def _read_raw(self, request: web.Request, video_path: str) -> tuple[Dict[str, Any], bool]:
+        """Read a raw video body; task metadata comes from headers or the query string"""
+        data = {
+            'task_id': request.headers.get('X-Task-Id') or request.query.get('task_id'),
+            'status': request.headers.get('X-Status') or request.query.get('status', 'success')
+        }
+        detail = request.headers.get('X-Detail') or request.query.get('detail')
+        if detail:
+            data['detail'] = detail
+        size = await self._stream_to_file(request.content, video_path)
+        return data, size > 0
+    
+    async def _read_multipart(self, request: web.Request, video_path: str) -> tuple[Dict[str, Any], bool]:
+        """Read multipart form data with metadata fields and a `video` file part"""
+        data = {}
+        size = 0
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'video' or part.filename:
+                size = await self._stream_to_file(part, video_path)
+            elif part.name == 'metadata':
+                data.update(json.loads(await part.text()))
+            elif part.name:
+                data[part.name] = await part.text()
+        return data, size > 0
+    
+    async def _stream_to_file(self, stream, video_path: str) -> int:
+        """Copy a request or multipart stream to disk, enforcing the body limit"""
+        size = 0
+        with open(video_path, 'wb') as sink:
+            while True:
+                if isinstance(stream, aiohttp.BodyPartReader):
+                    chunk = await stream.read_chunk(WEBHOOK_READ_CHUNK)
+                else:
+                    chunk = await stream.read(WEBHOOK_READ_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_body:
+                    raise web.HTTPRequestEntityTooLarge(max_size=self.max_body, actual_size=size)
+                sink.write(chunk)
+        return size
+    
+    def _delivery_done(self, delivery: asyncio.Task):
+        """Release the slot held by a finished delivery"""
+        self.deliveries.discard(delivery)
+        self.slots.release()
+    
+    async def health_check(self, request: web.Request) -> web.Response:
+        """Health check endpoint"""
+        return web.json_response({
+            "status": "healthy",
+            "bot_running": self.bot.client.is_connected(),
+            "webhook_url": self.bot.WEBHOOK_URL,
+            "deliveries_in_progress": len(self.deliveries),
+            "backends": self.bot.backend.stats(),
+            "sessions": self.bot.sessions.stats(),
+            "cost_model": self.bot.cost_model.stats()
+        })
+    
+    async def metrics(self, request: web.Request) -> web.Response:
+        """Prometheus metrics endpoint"""
+        QUEUE_RUNNING.set(await self.bot.coordinator.backend_slots())
+        QUEUE_WAITING.set(len(self.bot.task_queue.waiting))
+        return web.Response(
+            body=metrics.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
 
 if __name__ == '__main__':
     bot_instance = WanVideoBot()
     
-    # Run Flask in separate thread
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    
     logger.info("Bot and Webhook server started!")
     logger.info(f"Webhook URL: {bot_instance.WEBHOOK_URL}")
-    logger.info(f"Rate limit: {MAX_REQUESTS_PER_HOUR} requests per hour")
-    logger.info(f"Max concurrent tasks per user: {CONCURRENT_TASKS_PER_USER}")
+    logger.info(f"GPU quota: {USER_GPU_BUDGET:.0f} GPU-seconds per user per hour, "
+                f"backend budget {GLOBAL_GPU_RATE:g}/s with {GLOBAL_GPU_BURST:.0f} burst")
+    logger.info("Tiers: " + ', '.join(
+        f"{tier.name} (weight {tier.weight:g}, {tier.max_tasks} task(s)/user)" for tier in bot_instance.tiers.values()
+    ))
     logger.info(f"Max global queue: {MAX_GLOBAL_QUEUE}")
+    logger.info(f"Coordination backend: {COORDINATION_BACKEND}")
+    logger.info(f"Backend endpoints: {', '.join(MODAL_API_URLS)}")
     
     bot_instance.run()